@@ -0,0 +1,247 @@
+import json
+import re
+import time
+import argparse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils import get_completion_from_messages, call_with_retries, estimate_tokens
+from checkpoint import decision_records
+from prompts import BATCH_RESIDENT_PATTERN
+
+
+class DecisionBackend:
+    '''
+    Answers the stay-at-home prompt of an agent.
+    complete() returns the raw completion text ("Reasoning: ... Response: ...")
+    that Citizen.get_response_and_reasoning parses.
+    Backends with vectorized set also provide decide_day(model), which World.get_decisions
+    uses to answer every agent of a day at once.
+    source is recorded with every decision in the agents' mems.
+    Backends with supports_batching can answer prompts.batch_prompt, which asks for several agents
+    in one request (see World.query_decisions); the agent passed to complete() is then the batch's first.
+    '''
+    vectorized = False
+    supports_batching = False
+    source = "llm"
+
+    def complete(self, messages, agent):
+        raise NotImplementedError
+
+
+class OpenAIBackend(DecisionBackend):
+    '''
+    Queries the OpenAI chat completion API. The API key is read from the OPENAI_API_KEY environment variable.
+    '''
+    supports_batching = True
+
+    def __init__(self, model="gpt-3.5-turbo-0301", cache=None, rate_limiter=None, max_retries=8, usage=None):
+        self.model = model
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.usage = usage
+
+    def complete(self, messages, agent):
+        return get_completion_from_messages(messages, model=self.model, temperature=0, cache=self.cache,
+                                            rate_limiter=self.rate_limiter, max_retries=self.max_retries, usage=self.usage)
+
+
+class HTTPBackend(DecisionBackend):
+    '''
+    Queries an OpenAI-compatible chat completion server, e.g. a local model server
+    or the stand-in server started with `python backends.py --serve`.
+    '''
+    supports_batching = True
+
+    def __init__(self, url="http://127.0.0.1:8000", model="gpt-3.5-turbo-0301", cache=None, rate_limiter=None, max_retries=8, usage=None, timeout=60):
+        self.url = url.rstrip("/") + "/v1/chat/completions"
+        self.model = model
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.usage = usage
+        self.timeout = timeout
+
+    def request(self, payload):
+        request = urllib.request.Request(self.url, data=payload, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def complete(self, messages, agent):
+        if self.cache is not None:
+            key = self.cache.make_key(messages, self.model, 0, f"http:{self.url}")
+            content = self.cache.get(key)
+            if content is not None:
+                if self.usage is not None:
+                    self.usage.add(cache_hits=1)
+                return content
+
+        payload = json.dumps({"model": self.model, "messages": messages, "temperature": 0}).encode("utf-8")
+        response, retries = call_with_retries(lambda: self.request(payload), estimate_tokens(messages), self.rate_limiter, self.max_retries)
+        content = response["choices"][0]["message"]["content"]
+        if self.usage is not None:
+            tokens = response.get("usage", {})
+            self.usage.add(prompt_tokens=tokens.get("prompt_tokens", 0), completion_tokens=tokens.get("completion_tokens", 0), retries=retries)
+
+        if self.cache is not None:
+            self.cache.put(key, content)
+        return content
+
+
+class ReplayBackend(DecisionBackend):
+    '''
+    Answers from the decisions recorded in a checkpoint of a previous run (or its reasoning log), keyed by agent ID and step.
+    The checkpoint can be in any format World.load_checkpoint reads: a pickle, a columnar .npz file or a delta directory
+    (replayed up to its latest day).
+    Only the checkpoint path is pickled; the recorded answers are reloaded on first use.
+    '''
+    source = "replay"
+
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+        self.records = None
+        self.seed = None
+
+    def load_records(self):
+        from world import World #world imports this module
+        model = World.load_checkpoint(self.checkpoint_path, load_mems=False) #decisions are read from the reasoning log, if any
+        self.records = {(uid, step): (mem["reasoning"], mem["response"]) for uid, step, mem in decision_records(model)}
+        self.seed = getattr(model, "seed", None)
+
+    def recorded_seed(self):
+        '''
+        Seed of the recorded run, used by World to replay it with the same random draws
+        '''
+        if self.records is None:
+            self.load_records()
+        if self.seed is None:
+            raise ValueError(f"{self.checkpoint_path} does not record its seed. Pass --seed to replay it.")
+        return self.seed
+
+    def complete(self, messages, agent):
+        if self.records is None:
+            self.load_records()
+        step = agent.model.schedule.steps
+        if (agent.unique_id, step) not in self.records:
+            raise KeyError(f"No recorded decision for agent {agent.unique_id} at step {step} in {self.checkpoint_path}")
+        reasoning, response = self.records[(agent.unique_id, step)]
+        if reasoning is None: #The recorded output could not be parsed, so neither can the replayed one
+            return ""
+        return f"Reasoning: {reasoning}\nResponse: {response}"
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["records"] = None
+        return state
+
+
+def synthetic_decision(text, new_cases, threshold=1.0):
+    '''
+    Rule-based (reasoning, response): stay home with a fever, or with a cough
+    once the newspaper reports at least threshold% new infections.
+    '''
+    if "has a fever and a cough" in text:
+        return "They have a fever and a cough and do not want to infect others.", "Yes"
+    if "has a light cough" in text and new_cases >= threshold:
+        return "They have a light cough and the number of new infections is high.", "Yes"
+    return "They feel well enough to go to work.", "No"
+
+
+def synthetic_completion(prompt, threshold=1.0):
+    '''
+    Answers a stay-at-home prompt with synthetic_decision, as a JSON list for batched prompts (see prompts.batch_prompt).
+    Used by SyntheticBackend and the stand-in server.
+    '''
+    match = re.search(r"finds that\s*([\d.]+)%", prompt)
+    new_cases = float(match.group(1)) if match else 0.0
+
+    residents = BATCH_RESIDENT_PATTERN.findall(prompt)
+    if residents:
+        answers = [synthetic_decision(text, new_cases, threshold) for _, text in residents]
+        return json.dumps([{"resident": int(number), "reasoning": reasoning, "response": response}
+                           for (number, _), (reasoning, response) in zip(residents, answers)])
+    reasoning, response = synthetic_decision(prompt, new_cases, threshold)
+    return f"Reasoning: {reasoning}\nResponse: {response}"
+
+
+class SyntheticBackend(DecisionBackend):
+    '''
+    Offline, deterministic stand-in for the LLM. latency (in seconds) is slept on every call
+    to mimic network round-trips when load-testing the simulation.
+    '''
+    supports_batching = True
+    source = "synthetic"
+
+    def __init__(self, latency=0.0, threshold=1.0):
+        self.latency = latency
+        self.threshold = threshold
+
+    def complete(self, messages, agent):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return synthetic_completion(messages[-1]["content"], self.threshold)
+
+
+def get_backend(args, cache=None, rate_limiter=None, usage=None):
+    '''
+    Builds the decision backend selected by args.backend
+    Used in World.init
+    '''
+    if args.backend == "openai":
+        return OpenAIBackend(model=args.model, cache=cache, rate_limiter=rate_limiter, max_retries=args.max_retries, usage=usage)
+    if args.backend == "http":
+        return HTTPBackend(url=args.backend_url, model=args.model, cache=cache, rate_limiter=rate_limiter, max_retries=args.max_retries, usage=usage)
+    if args.backend == "replay":
+        if not args.replay_from:
+            raise ValueError("--replay_from must point to a checkpoint when using the replay backend.")
+        return ReplayBackend(args.replay_from)
+    if args.backend == "synthetic":
+        return SyntheticBackend(latency=args.synthetic_latency)
+    if args.backend == "surrogate":
+        from surrogate import SurrogateBackend #needs scikit-learn, which the other backends do not
+        return SurrogateBackend(args.surrogate_path, args.surrogate_threshold)
+    if args.backend == "hybrid":
+        from surrogate import HybridBackend
+        llm = get_backend(argparse.Namespace(**{**vars(args), "backend": args.escalation_backend}), cache, rate_limiter, usage)
+        return HybridBackend(args.surrogate_path, llm, args.escalation_budget, args.escalation_margin, args.surrogate_threshold)
+    raise ValueError(f"Unknown decision backend '{args.backend}'.")
+
+
+def serve(host="127.0.0.1", port=8000, latency=0.0, threshold=1.0):
+    '''
+    Runs an OpenAI-compatible chat completion server that answers with synthetic_completion.
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if latency > 0:
+                time.sleep(latency)
+            content = synthetic_completion(body["messages"][-1]["content"], threshold)
+            prompt_tokens = estimate_tokens(body["messages"], completion_tokens=0)
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4, "total_tokens": prompt_tokens + len(content) // 4}
+            payload = json.dumps({"choices": [{"message": {"role": "assistant", "content": content}}], "usage": usage}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"Serving synthetic decisions on http://{host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--serve", action="store_true", help="Start the synthetic stand-in server.")
+    parser.add_argument("--host", default="127.0.0.1", help="Host of the stand-in server.")
+    parser.add_argument("--port", default=8000, type=int, help="Port of the stand-in server.")
+    parser.add_argument("--latency", default=0.0, type=float, help="Seconds slept before answering each request.")
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.host, args.port, args.latency)
+    else:
+        parser.print_help()
@@ -0,0 +1,52 @@
+import argparse
+import json
+import sys
+
+
+def load_results(path):
+    with open(path) as file:
+        report = json.load(file)
+    return report, {(r["population"], r["contact_rate"], r["engine"], r["matching"]): r for r in report["results"]}
+
+
+def compare(base, new, threshold=1.25, min_seconds=0.01):
+    '''
+    Rows of (configuration, phase, base seconds, new seconds, ratio) for every phase timed in both reports,
+    and the rows that slowed down by more than threshold. Phases under min_seconds in the base report are
+    too noisy to flag. Peak memory is compared as the phase "peak_rss_mb".
+    '''
+    rows, regressions = [], []
+    for key in sorted(set(base) & set(new)):
+        phases = {**base[key]["seconds"], "peak_rss_mb": base[key]["peak_rss_mb"]}
+        for phase, before in phases.items():
+            after = new[key]["peak_rss_mb"] if phase == "peak_rss_mb" else new[key]["seconds"].get(phase)
+            if before is None or after is None:
+                continue
+            ratio = after / before if before > 0 else float("inf")
+            rows.append((key, phase, before, after, ratio))
+            if ratio > threshold and (phase == "peak_rss_mb" or before >= min_seconds):
+                regressions.append(rows[-1])
+    return rows, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares two reports written by benchmarks/run_benchmarks.py. "
+                                     "Exits with status 1 if a phase slowed down by more than --threshold.")
+    parser.add_argument("base", help="Report of the reference commit.")
+    parser.add_argument("new", help="Report of the commit to check.")
+    parser.add_argument("--threshold", default=1.25, type=float, help="Ratio new/base above which a phase counts as a regression.")
+    parser.add_argument("--min_seconds", default=0.01, type=float, help="Phases faster than this in the base report are not flagged.")
+    args = parser.parse_args()
+
+    (base_report, base), (new_report, new) = load_results(args.base), load_results(args.new)
+    print(f"base: {base_report['commit']} ({base_report['created']})\nnew:  {new_report['commit']} ({new_report['created']})")
+    rows, regressions = compare(base, new, args.threshold, args.min_seconds)
+    for row in rows:
+        (population, contact_rate, engine, matching), phase, before, after, ratio = row
+        flag = " <-- regression" if row in regressions else ""
+        print(f"{population:>7} {contact_rate:>3} {engine:>10}/{matching:<6} {phase:<16} {before:>10.4f} {after:>10.4f} {ratio:>7.2f}x{flag}")
+    missing = set(base) ^ set(new)
+    if missing:
+        print(f"{len(missing)} configurations are only in one of the reports and were not compared.")
+    print(f"{len(regressions)} regressions above {args.threshold}x")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,63 @@
+import os
+import sys
+import argparse
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#Import-time budget (seconds, best of --repeat fresh interpreters) of each entry point,
+#and the heavy modules it must not import at startup
+BUDGETS = {"main": (0.5, ["world", "mesa", "pandas", "matplotlib", "openai", "sklearn"]),
+           "world": (1.5, ["matplotlib", "openai", "sklearn", "names_dataset"]),
+           "sweep": (1.0, ["world", "mesa", "matplotlib", "openai"])}
+
+
+def import_time(module):
+    '''
+    Seconds it takes a fresh interpreter to import module from the repository root, read from -X importtime,
+    and the names of the top-level packages it imported
+    '''
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=REPO, check=True)
+    microseconds, imported = 0, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue #header line
+        imported.add(name.strip().split(".")[0])
+        if name.strip() == module:
+            microseconds = int(cumulative)
+    return microseconds / 1e6, imported
+
+
+def check(modules, repeat=3, scale=1.0):
+    '''
+    Rows of (module, best seconds, budget, forbidden modules imported) and whether every module is within its budget
+    '''
+    rows, ok = [], True
+    for module in modules:
+        budget, forbidden = BUDGETS[module]
+        timings = [import_time(module) for _ in range(repeat)]
+        seconds = min(seconds for seconds, _ in timings)
+        loaded = sorted(set(forbidden) & set.union(*[imported for _, imported in timings]))
+        rows.append((module, seconds, budget * scale, loaded))
+        ok = ok and seconds <= budget * scale and not loaded
+    return rows, ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks the startup import time of the entry points against their budgets "
+                                     "and that they do not import heavy modules eagerly. Exits with status 1 on a violation.")
+    parser.add_argument("--modules", nargs="+", default=list(BUDGETS), choices=list(BUDGETS), help="Entry points to check.")
+    parser.add_argument("--repeat", default=3, type=int, help="Fresh interpreters per entry point; the fastest counts.")
+    parser.add_argument("--scale", default=1.0, type=float, help="Multiplies every budget, e.g. for slower machines.")
+    args = parser.parse_args()
+
+    rows, ok = check(args.modules, args.repeat, args.scale)
+    for module, seconds, budget, loaded in rows:
+        flag = "" if seconds <= budget else " <-- over budget"
+        flag += f" <-- imports {', '.join(loaded)}" if loaded else ""
+        print(f"{module:<8} {seconds:>7.3f} s (budget {budget:.2f} s){flag}")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,172 @@
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import world
+from world import World
+from main import get_parser
+from eval import build_panel
+from utils import load_top_names, generate_big5_traits
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+import multiprocessing
+import subprocess
+import tempfile
+import platform
+import argparse
+import random
+import json
+import time
+import numpy as np
+
+try:
+    import resource
+except ImportError: #not available on Windows, where peak memory is not reported
+    resource = None
+
+
+@contextmanager
+def timed(obj, name, timings, key):
+    '''
+    Replaces obj.name with a wrapper that adds the time spent in it to timings[key]
+    '''
+    function = getattr(obj, name)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings[key] = timings.get(key, 0.0) + time.perf_counter() - start
+    setattr(obj, name, wrapper)
+    try:
+        yield
+    finally:
+        if obj is world:
+            setattr(obj, name, function)
+        else:
+            delattr(obj, name) #back to the class attribute, so the World can be pickled again
+
+
+def get_personas(population, seed):
+    '''
+    Personas for populations larger than the name tables allow (generate_names draws distinct names
+    from the 2*population most popular ones): names are reused cyclically.
+    '''
+    rng = random.Random(seed)
+    male_names, female_names = load_top_names(population)
+    pool = male_names + female_names
+    names = [pool[i % len(pool)] for i in range(population)]
+    return names, [rng.randrange(18, 65) for _ in range(population)], generate_big5_traits(population, rng)
+
+
+def benchmark(population, contact_rate, engine, matching, days, seed):
+    '''
+    Times every phase of a run of days days with the synthetic backend. Runs in its own process,
+    so that the peak resident memory is that of this configuration only.
+    '''
+    args = get_parser().parse_args(["--backend", "synthetic", "--cache_path", "", "--engine", engine, "--matching", matching,
+                                    "--contact_rate", str(contact_rate), "--no_days", str(days), "--seed", str(seed)])
+    initial_infected = max(population // 100, 1)
+    male_names, female_names = load_top_names(population * 2)
+    personas = None if min(len(male_names), len(female_names)) >= (population + 1) // 2 else get_personas(population, seed)
+
+    timings = {}
+    start = time.perf_counter()
+    model = World(args, initial_healthy=population - initial_infected, initial_infected=initial_infected,
+                  contact_rate=contact_rate, personas=personas)
+    timings["init"] = time.perf_counter() - start
+
+    contacts = []
+    with timed(model, "get_decisions", timings, "decisions"), \
+         timed(model, "decide_agent_interactions", timings, "interactions"), \
+         timed(model, "vectorized_step", timings, "vectorized_step"), \
+         timed(model.schedule, "step", timings, "agent_steps"), \
+         timed(world, "update_day", timings, "update_day"):
+        for _ in range(days):
+            start = time.perf_counter()
+            model.datacollector.collect(model)
+            timings["datacollector"] = timings.get("datacollector", 0.0) + time.perf_counter() - start
+            start = time.perf_counter()
+            model.step()
+            timings["step"] = timings.get("step", 0.0) + time.perf_counter() - start
+            contacts.append(model.track_contact_rate[-1] / max(model.state.num_on_grid, 1))
+    #Time of the step not spent in the phases above, e.g. applying the decisions to the Citizens
+    timings["step_other"] = timings["step"] - sum(timings.get(key, 0.0) for key in ["decisions", "interactions", "vectorized_step", "agent_steps", "update_day"])
+
+    with tempfile.TemporaryDirectory() as directory:
+        for extension in ["pkl", "npz"]:
+            path = os.path.join(directory, f"benchmark.{extension}")
+            start = time.perf_counter()
+            model.save_checkpoint(path)
+            timings[f"save_{extension}"] = time.perf_counter() - start
+            start = time.perf_counter()
+            World.load_checkpoint(path)
+            timings[f"load_{extension}"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    build_panel(model)
+    timings["eval_panel"] = time.perf_counter() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource is not None else None
+    return {"population": population, "contact_rate": contact_rate, "engine": engine, "matching": matching, "days": days,
+            "tiled_names": personas is not None, "mean_contacts": float(np.mean(contacts)),
+            "seconds": timings, "peak_rss_mb": peak}
+
+
+def get_configurations(populations, contact_rates, engines, max_legacy):
+    '''
+    Every (population, contact rate, engine, matching) to benchmark. The object engine is run with both
+    matching modes, legacy matching (quadratic in the number of agents) only up to max_legacy agents.
+    '''
+    configurations = []
+    for population in populations:
+        for contact_rate in contact_rates:
+            for engine in engines:
+                matchings = ["stub", "legacy"] if engine == "object" and population <= max_legacy else ["stub"]
+                configurations += [(population, contact_rate, engine, matching) for matching in matchings]
+    return configurations
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the phases of the simulation with the synthetic backend "
+                                     "and writes a JSON report that benchmarks/compare.py can compare between commits.")
+    parser.add_argument("--populations", nargs="+", default=[100, 1000, 10000, 100000], type=int, help="Numbers of agents.")
+    parser.add_argument("--contact_rates", nargs="+", default=[2, 5, 10, 20], type=int, help="Contact rates.")
+    parser.add_argument("--engines", nargs="+", default=["object", "vectorized"], choices=["object", "vectorized"], help="Simulation engines.")
+    parser.add_argument("--max_legacy", default=1000, type=int, help="Largest population run with legacy contact matching.")
+    parser.add_argument("--days", default=3, type=int, help="Days simulated per configuration.")
+    parser.add_argument("--seed", default=0, type=int, help="Seed of every run.")
+    parser.add_argument("--output", default=None, help="Report path. Defaults to benchmarks/results/{commit}.json")
+    args = parser.parse_args()
+
+    commit = get_commit()
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"{commit or 'report'}.json")
+    report = {"commit": commit,
+              "created": datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "platform": platform.platform(),
+              "results": []}
+
+    for population, contact_rate, engine, matching in get_configurations(args.populations, args.contact_rates, args.engines, args.max_legacy):
+        #A fresh process per configuration, so peak memory is not carried over from larger runs
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(benchmark, population, contact_rate, engine, matching, args.days, args.seed).result()
+        report["results"].append(result)
+        print(f"{population:>7} agents, contact rate {contact_rate:>2}, {engine}/{matching}: "
+              f"step {result['seconds']['step'] / args.days:.3f} s/day, init {result['seconds']['init']:.3f} s, "
+              f"peak {result['peak_rss_mb'] or 0:.0f} MB")
+
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as file: #rewritten after every configuration, so a long run can be interrupted
+            json.dump(report, file, indent=2)
+    print(f"Report written to {output}")
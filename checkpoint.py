@@ -0,0 +1,459 @@
+import io
+import os
+import re
+import gzip
+import json
+import queue
+import pickle
+import argparse
+import threading
+from datetime import datetime
+import numpy as np
+
+#Version of the columnar checkpoint layout written by save_columnar.
+#Version 2 writes the agent columns in ID order and adds agent_order; version 1 files are still read.
+CHECKPOINT_SCHEMA_VERSION = 2
+
+
+def write_atomic(file_path, data):
+    '''
+    Writes data next to file_path, fsyncs it and moves it into place, so a partly written file is never seen at file_path
+    '''
+    with open(file_path + ".tmp", "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(file_path + ".tmp", file_path)
+
+
+class CheckpointWriter:
+    '''
+    Writes checkpoints with write_atomic on a background thread, so the simulation does not wait on disk I/O.
+    Checkpoints are submitted already serialized, so later changes to the World cannot reach them.
+    At most max_pending checkpoints wait to be written; submit() blocks beyond that.
+    A failed write is raised by the next submit(), flush() or close(). Used as a context manager,
+    every submitted checkpoint is written before the with block is left, also when it raises.
+    Used in World.run_model
+    '''
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max(max_pending, 1))
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="checkpoint-writer", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None: #after a failure, later checkpoints are dropped until the error is raised
+                    write_atomic(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, file_path, data):
+        self.raise_error()
+        self.queue.put((file_path, data))
+
+    def flush(self):
+        '''
+        Waits until every submitted checkpoint is written
+        '''
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        try:
+            self.close()
+        except Exception: #keep the error that left the with block
+            pass
+
+
+def write_checkpoint(file_path, data, writer=None):
+    '''
+    Writes serialized checkpoint data through writer (a CheckpointWriter) if given, and right away otherwise
+    '''
+    if writer is not None:
+        writer.submit(file_path, data)
+    else:
+        write_atomic(file_path, data)
+
+
+class DeltaCheckpointStore:
+    '''
+    Checkpoints of one run stored as a base snapshot plus one append-only delta per day,
+    so that the cost of a daily checkpoint does not grow with the length of the run.
+    directory/base-{day}.pkl: pickled World at the end of day, which keeps the scheduler's agent order
+    directory/delta-{day}.pkl: what changed during day (state changes, list tails, new mems entries, the scheduler's agent order)
+    Files are written through writer (a CheckpointWriter) if given.
+    Used in World.run_model and World.load_checkpoint
+    '''
+    def __init__(self, directory, writer=None):
+        self.directory = directory
+        self.writer = writer
+        os.makedirs(directory, exist_ok=True)
+        self.last = None #Snapshot of the last saved day the next delta is computed against
+
+    def days(self, kind):
+        pattern = re.compile(rf"{kind}-(\d+)\.pkl$")
+        return sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(self.directory)) if match)
+
+    def path(self, kind, day):
+        return os.path.join(self.directory, f"{kind}-{day}.pkl")
+
+    def has_day(self, day):
+        bases = [base for base in self.days("base") if base <= day]
+        return bool(bases) and all(d in self.days("delta") for d in range(bases[-1] + 1, day + 1))
+
+    def clear(self):
+        for kind in ["base", "delta"]:
+            for d in self.days(kind):
+                os.remove(self.path(kind, d))
+        self.last = None
+
+    def snapshot(self, model):
+        return {"health": model.state.health.copy(),
+                "day_infected": model.state.day_infected.copy(),
+                "on_grid": model.state.on_grid.copy(),
+                "lists": {name: len(getattr(model, name)) for name in model.CHECKPOINT_LISTS},
+                "model_vars": {name: len(values) for name, values in model.datacollector.model_vars.items()},
+                "steps": model.schedule.steps}
+
+    def track(self, model, day):
+        '''
+        Starts tracking a model resumed at day, so the next delta is computed against it.
+        A base snapshot is written if the store has none at or before day.
+        '''
+        if not any(base <= day for base in self.days("base")):
+            self.write(self.path("base", day), model)
+        self.last = self.snapshot(model)
+
+    def save(self, model, day):
+        '''
+        Writes a base snapshot if nothing is tracked yet, and a delta against the last saved day otherwise.
+        '''
+        if self.last is None:
+            self.write(self.path("base", day), model)
+            self.last = self.snapshot(model)
+            return
+
+        state = model.state
+        changed = np.flatnonzero((state.health != self.last["health"]) |
+                                 (state.day_infected != self.last["day_infected"]) |
+                                 (state.on_grid != self.last["on_grid"]))
+        new_mems = {}
+        for agent in model.schedule.agents:
+            entries = {step: mem for step, mem in agent.mems.items() if isinstance(step, int) and step >= self.last["steps"]}
+            if entries:
+                new_mems[agent.unique_id] = entries
+
+        delta = {"day": day,
+                 "scalars": {name: getattr(model, name) for name in model.CHECKPOINT_SCALARS},
+                 "steps": model.schedule.steps,
+                 "time": model.schedule.time,
+                 "rng": model.get_rng_state(),
+                 "schedule": model.get_schedule_order(),
+                 "changed": changed,
+                 "health": state.health[changed],
+                 "day_infected": state.day_infected[changed],
+                 "on_grid": state.on_grid[changed],
+                 "agents_on_grid": np.array([agent.unique_id for agent in model.agents_on_grid], dtype=np.int64),
+                 "lists": {name: getattr(model, name)[self.last["lists"][name]:] for name in model.CHECKPOINT_LISTS},
+                 "model_vars": {name: values[self.last["model_vars"].get(name, 0):] for name, values in model.datacollector.model_vars.items()},
+                 "mems": new_mems}
+        self.write(self.path("delta", day), delta)
+        self.last = self.snapshot(model)
+
+    def load(self, day=None):
+        '''
+        Restores the World at the end of day (the latest saved day if None)
+        from the latest base snapshot before it and the deltas after that base.
+        '''
+        bases = self.days("base")
+        deltas = self.days("delta")
+        if day is None:
+            day = max(bases + deltas)
+        bases = [base for base in bases if base <= day]
+        if not bases:
+            raise FileNotFoundError(f"No base checkpoint at or before day {day} in {self.directory}")
+
+        model = self.read(self.path("base", bases[-1]))
+        agents = {agent.unique_id: agent for agent in model.schedule.agents}
+        for d in range(bases[-1] + 1, day + 1):
+            if d not in deltas:
+                raise FileNotFoundError(f"Missing delta checkpoint for day {d} in {self.directory}")
+            delta = self.read(self.path("delta", d))
+            for name, value in delta["scalars"].items():
+                setattr(model, name, value)
+            model.schedule.steps = delta["steps"]
+            model.schedule.time = delta["time"]
+            model.set_rng_state(delta["rng"])
+            if "schedule" in delta: #deltas written before the order was saved keep the base snapshot's order
+                model.set_schedule_order(delta["schedule"])
+            model.state.health[delta["changed"]] = delta["health"]
+            model.state.day_infected[delta["changed"]] = delta["day_infected"]
+            model.state.on_grid[delta["changed"]] = delta["on_grid"]
+            model.agents_on_grid = [agents[uid] for uid in delta["agents_on_grid"]]
+            for name, tail in delta["lists"].items():
+                getattr(model, name).extend(tail)
+            for name, tail in delta["model_vars"].items():
+                model.datacollector.model_vars.setdefault(name, []).extend(tail)
+            for uid, entries in delta["mems"].items():
+                agents[uid].mems.update(entries)
+        model.state.recount()
+        model.trim_mems()
+        self.last = self.snapshot(model)
+        return model
+
+    def compact(self, day=None):
+        '''
+        Folds the deltas up to day into a new base snapshot and removes the files it replaces.
+        '''
+        day = max(self.days("base") + self.days("delta")) if day is None else day
+        model = self.load(day)
+        self.write(self.path("base", day), model)
+        for kind in ["base", "delta"]:
+            for d in self.days(kind):
+                if d < day or (kind == "delta" and d == day):
+                    os.remove(self.path(kind, d))
+        return model
+
+    def write(self, file_path, obj):
+        write_checkpoint(file_path, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), self.writer)
+
+    @staticmethod
+    def read(file_path):
+        with open(file_path, "rb") as file:
+            return pickle.load(file)
+
+
+def encode_records(records):
+    '''
+    Decision records ({"id": agent id, "step": step, **mems entry}) as gzipped JSON lines
+    '''
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=1) as file: #fastest level: JSON still shrinks about 10x
+        for record in records:
+            file.write((json.dumps(record) + "\n").encode("utf-8"))
+    return buffer.getvalue()
+
+
+def write_records(file_path, records, writer=None):
+    '''
+    Writes decision records (see encode_records) with write_checkpoint
+    '''
+    write_checkpoint(file_path, encode_records(records), writer)
+
+
+def read_records(file_path):
+    with gzip.open(file_path, "rt", encoding="utf-8") as file:
+        for line in file:
+            yield json.loads(line)
+
+
+class ReasoningLog:
+    '''
+    Append-only on-disk log of every decision of a run, streamed as the run goes
+    so that the Citizens only keep the last mems_tail days of mems in memory.
+    directory/day-{step}.jsonl.gz: the decision records of one step (see write_records)
+    end: steps from end on are ignored, e.g. when the log is read through a checkpoint of an earlier day
+    than the run went on to
+    The directory is kept as an absolute path, so a pickled World finds its log from any working directory.
+    Used in World.run_model and save_columnar
+    '''
+    end = None
+
+    def __init__(self, directory, end=None):
+        self.directory = os.path.abspath(directory)
+        self.end = end
+
+    def check(self):
+        '''
+        Raises if the log a loaded checkpoint refers to is missing, instead of reading it as a run without decisions
+        '''
+        if not os.path.isdir(self.directory):
+            raise FileNotFoundError(f"Reasoning log {self.directory} referred to by the checkpoint does not exist.")
+
+    def steps(self, start=0):
+        pattern = re.compile(r"day-(\d+)\.jsonl\.gz$")
+        steps = sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(self.directory)) if match)
+        return [step for step in steps if step >= start and (self.end is None or step < self.end)]
+
+    def path(self, step):
+        return os.path.join(self.directory, f"day-{step}.jsonl.gz")
+
+    def write(self, model, step, writer=None):
+        agents = model.schedule.agents
+        write_records(self.path(step), ({"id": agent.unique_id, "step": step, **agent.mems[step]} for agent in agents if step in agent.mems), writer)
+
+    def clear(self, start=0):
+        '''
+        Removes the chunks of start and later steps, e.g. those written after the checkpoint a run resumes from
+        '''
+        for step in self.steps(start):
+            os.remove(self.path(step))
+
+    def read(self, start=0):
+        '''
+        Decision records of the steps from start on
+        '''
+        for step in self.steps(start):
+            yield from read_records(self.path(step))
+
+    def __iter__(self):
+        return self.read()
+
+
+def decision_records(model):
+    '''
+    Yields (agent id, step, mems entry) of every decision of a run, from its ReasoningLog if it streamed one
+    and from the Citizens' mems otherwise.
+    Used in backends.ReplayBackend, surrogate.py and eval.py
+    '''
+    if getattr(model, "reasoning_log", None) is not None:
+        for record in model.reasoning_log:
+            yield record.pop("id"), record.pop("step"), record
+        return
+    for agent in model.schedule.agents:
+        for step, mem in agent.mems.items():
+            if isinstance(step, int):
+                yield agent.unique_id, step, mem
+
+
+def reasoning_log_path(file_path):
+    return file_path[:-len(".npz")] + "-reasoning.jsonl.gz"
+
+
+def save_columnar(model, file_path, writer=None):
+    '''
+    Writes a columnar checkpoint that does not depend on pickling live mesa objects:
+    file_path (.npz): agent columns (in ID order), the scheduler's agent order, world counters and tracking lists,
+    tagged with CHECKPOINT_SCHEMA_VERSION
+    Runs streaming a ReasoningLog (every columnar run, see World.run_model) write their decisions one day at a time
+    to the log, which the checkpoint refers to (relative to its own directory) up to its step,
+    so saving does not grow with the length of the run.
+    Otherwise the decision records in the Citizens' mems are written to reasoning_log_path(file_path) (see write_records).
+    Files are written with write_checkpoint.
+    Used in World.save_checkpoint
+    '''
+    agents = sorted(model.schedule.agents, key=lambda agent: agent.unique_id)
+    scalars = {name: getattr(model, name) for name in model.CHECKPOINT_SCALARS}
+    scalars["current_date"] = model.current_date.isoformat()
+    meta = {"args": model.args,
+            "initial_healthy": model.initial_healthy,
+            "initial_infected": model.initial_infected,
+            "scalars": scalars,
+            "steps": model.schedule.steps,
+            "time": model.schedule.time,
+            "rng": model.get_rng_state(),
+            "lists": {name: getattr(model, name) for name in model.CHECKPOINT_LISTS},
+            "model_vars": model.datacollector.model_vars,
+            "reasoning_log_dir": (os.path.relpath(model.reasoning_log.directory, os.path.dirname(os.path.abspath(file_path)))
+                                  if model.reasoning_log is not None else None),
+            "reasoning_log_end": model.schedule.steps}
+    buffer = io.BytesIO()
+    np.savez(buffer,
+             schema_version=np.array(CHECKPOINT_SCHEMA_VERSION),
+             meta=np.array(json.dumps(meta)),
+             name=np.array([agent.name for agent in agents]),
+             age=np.array([agent.age for agent in agents], dtype=np.int16),
+             traits=np.array([agent.traits for agent in agents]),
+             health=model.state.health,
+             day_infected=model.state.day_infected,
+             on_grid=model.state.on_grid,
+             agent_order=model.get_schedule_order(),
+             agents_on_grid=np.array([agent.unique_id for agent in model.agents_on_grid], dtype=np.int64))
+    write_checkpoint(file_path, buffer.getvalue(), writer)
+
+    if model.reasoning_log is None:
+        write_records(reasoning_log_path(file_path), ({"id": agent.unique_id, "step": step, **mem}
+                                                      for agent in agents for step, mem in agent.mems.items() if isinstance(step, int)), writer)
+
+
+def load_columnar(file_path, world_cls, load_mems=True):
+    '''
+    Rebuilds a World (Citizens, grid, state and tracking lists) from a columnar checkpoint.
+    Decisions kept in a ReasoningLog are only read into the Citizens' mems (the last mems_tail days of them,
+    or all if mems_tail is 0) if load_mems is True; decision_records reads them from the log either way.
+    Checkpoints without a log always load the records saved next to them, their only copy.
+    Used in World.load_checkpoint
+    '''
+    with np.load(file_path) as data:
+        version = int(data["schema_version"])
+        if version not in (1, CHECKPOINT_SCHEMA_VERSION):
+            raise ValueError(f"Checkpoint {file_path} has schema version {version}, expected {CHECKPOINT_SCHEMA_VERSION}.")
+        meta = json.loads(str(data["meta"]))
+        columns = {key: data[key] for key in data.files}
+
+    personas = (columns["name"].tolist(), columns["age"].tolist(), columns["traits"].tolist())
+    model = world_cls(argparse.Namespace(**meta["args"]), initial_healthy=meta["initial_healthy"],
+                      initial_infected=meta["initial_infected"], contact_rate=meta["args"]["contact_rate"], personas=personas)
+    model.state.health[:] = columns["health"]
+    model.state.day_infected[:] = columns["day_infected"]
+    model.state.on_grid[:] = columns["on_grid"]
+    model.state.recount()
+    agents = {agent.unique_id: agent for agent in model.schedule.agents}
+    model.agents_on_grid = [agents[uid] for uid in columns["agents_on_grid"]]
+    if "agent_order" in columns: #version 1 checkpoints keep the ID order the World is rebuilt in
+        model.set_schedule_order(columns["agent_order"])
+
+    for name, value in meta["scalars"].items():
+        setattr(model, name, value)
+    model.current_date = datetime.fromisoformat(meta["scalars"]["current_date"])
+    model.schedule.steps = meta["steps"]
+    model.schedule.time = meta["time"]
+    model.set_rng_state(meta["rng"])
+    for name, values in meta["lists"].items():
+        setattr(model, name, values)
+    model.datacollector.model_vars = meta["model_vars"]
+
+    if meta.get("reasoning_log_dir"):
+        directory = os.path.join(os.path.dirname(os.path.abspath(file_path)), meta["reasoning_log_dir"])
+        model.reasoning_log = ReasoningLog(directory, end=meta.get("reasoning_log_end"))
+    elif meta.get("reasoning_log"): #earlier checkpoints saved the log's path as given to run_model
+        model.reasoning_log = ReasoningLog(meta["reasoning_log"], end=meta.get("reasoning_log_end"))
+    if model.reasoning_log is not None:
+        model.reasoning_log.check()
+    if model.reasoning_log is None:
+        records = read_records(reasoning_log_path(file_path))
+    elif not load_mems:
+        records = []
+    elif os.path.exists(reasoning_log_path(file_path)): #mems tail saved next to the checkpoint by earlier versions
+        records = read_records(reasoning_log_path(file_path))
+    else:
+        records = model.reasoning_log.read(max(model.schedule.steps - model.mems_tail, 0) if model.mems_tail else 0)
+    for record in records:
+        agents[record.pop("id")].mems[record.pop("step")] = record
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Delta checkpoint directory of a run, e.g. checkpoint/run-1/delta")
+    parser.add_argument("--compact", action="store_true", help="Fold the deltas into a new base snapshot.")
+    parser.add_argument("--day", default=None, type=int, help="Day to compact up to. Defaults to the latest saved day.")
+    args = parser.parse_args()
+    store = DeltaCheckpointStore(args.directory)
+    if args.compact:
+        store.compact(args.day)
+    print(f"Bases: {store.days('base')}\nDeltas: {store.days('delta')}")
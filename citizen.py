@@ -1,10 +1,14 @@
 import time
 import mesa
-from utils import get_completion_from_messages, probability_threshold
+from utils import probability_threshold
+from state import HEALTH_CONDITIONS, HEALTH_CODES, NOT_INFECTED
 import logging
 logger = logging.getLogger()
 logger.setLevel(logging.WARNING)
 
+#Name used in place of the agent's own name when prompts are canonicalized for decision deduplication
+CANONICAL_NAME = "Alex"
+
 
 class Citizen(mesa.Agent):
     '''
@@ -17,6 +21,7 @@ class Citizen(mesa.Agent):
     pos: position (x,y) tuple for grid position
     health_condition: flag to say if Susceptible or Infected or Recovered
     day_infected: agent attribute to count the number of days agent spends infected
+    location, health_condition and day_infected are views into model.state (see state.AgentState)
     width, height: dimensions of world
     '''
 
@@ -40,14 +45,40 @@ class Citizen(mesa.Agent):
         #Reasoning tracking
         self.mems = {"name":name,"age":age,"traits":traits}
 
+    #########################################
+    #        Views into model.state         #
+    #########################################
+    @property
+    def health_condition(self):
+        return HEALTH_CONDITIONS[self.model.state.health[self.unique_id]]
+
+    @health_condition.setter
+    def health_condition(self, value):
+        self.model.state.set_health(self.unique_id, HEALTH_CODES[value])
+
+    @property
+    def day_infected(self):
+        day = self.model.state.day_infected[self.unique_id]
+        return None if day == NOT_INFECTED else int(day)
+
+    @day_infected.setter
+    def day_infected(self, value):
+        self.model.state.set_day_infected(self.unique_id, NOT_INFECTED if value is None else value)
+
+    @property
+    def location(self):
+        return "grid" if self.model.state.on_grid[self.unique_id] else "home"
+
+    @location.setter
+    def location(self, value):
+        self.model.state.set_on_grid(self.unique_id, value == "grid")
+
     #########################################
     #             Health Feedback           #
     #########################################  
-    def get_health_string(self):
-        Health_strings=[f"{self.name} feels normal.",
-                        f"{self.name} has a light cough.",
-                        f"{self.name} has a fever and a cough.",
-                        ]
+    def get_health_string(self, name=None):
+        name = self.name if name is None else name
+        Health_strings = self.model.prompts.health_strings(name) #built once per name
 
         if self.health_condition=="Susceptible" or self.health_condition=="Recovered" or self.health_condition=="To_Be_Infected" or self.day_infected<=2:
             return Health_strings[0]
@@ -66,14 +97,18 @@ class Citizen(mesa.Agent):
     #      Decision-helper functions       #
     ########################################
 
-    def ask_agent_stay_at_home(self):
+    def ask_agent_stay_at_home(self, decision=None):
         '''
         Used in self.decide_location. Returns True or False depending on whether agent wants to
         stay at home.
+        decision: (reasoning, response, source) tuple already fetched by World.get_decisions. Queried here if None.
+        source names what answered the decision (see DecisionBackend.source) and is recorded in mems.
         '''
-        reasoning, response = self.get_response_and_reasoning()
+        if decision is None:
+            decision = (*self.get_response_and_reasoning(), self.model.backend.source)
+        reasoning, response, source = decision
         self.mems[self.model.schedule.steps] = {"health condition":self.health_condition,"reasoning": reasoning,
-        "response": response,"health string": self.get_health_string(),"location":self.location}
+        "response": response,"health string": self.get_health_string(),"location":self.location,"source": source}
         response = response.lower()
         if reasoning is None:
             reasoning = f"{self.name} did not give a reason."
@@ -92,49 +127,19 @@ class Citizen(mesa.Agent):
 
         
 
-    def get_response_and_reasoning(self):
+    def get_response_and_reasoning(self, name=None):
         '''
-        GAI of model. Uses ChatGPT to provide response and reasoning to the prompt provided.
+        GAI of model. Uses the model's decision backend (ChatGPT by default) to provide response and reasoning to the prompt provided.
+        name: name used in the prompt instead of the agent's own name (see World.get_decisions)
         '''
-        question_prompt = f"""
-        You are {self.name}. You are {self.age} years old. 
-       
-        Your traits are given below:
-        {self.traits}
-        
-        Your basic bio is below:
-        {self.name} lives in the town of Dewberry Hollow. {self.name} likes the town and has friends who also live there. {self.name} has a job and goes to the office for work everyday.
-        
-        I will provide {self.name}'s relevant memories here:
-        {self.get_health_string()}
-        {self.name} knows about the Catasat virus spreading across the country. It is an infectious disease that spreads from human to human contact via an airborne virus. The deadliness of the virus is unknown. Scientists are warning about a potential epidemic.
-        {self.name} checks the newspaper and finds that {(self.model.day_infected_is_4[self.model.schedule.steps]*100)/self.model.population: .1f}% of Dewberry Hollow's population caught new infections of the Catasat virus yesterday.
-        {self.name} goes to work to earn money to support {self.name}'s self.
-       
-        Based on the provided memories, should {self.name} stay at home for the entire day? Please provide your reasoning.
-
-        If the answer is "Yes," please state your reasoning as "Reasoning: [explanation]." 
-        If the answer is "No," please state your reasoning as "Reasoning: [explanation]."
-        
-        The format should be as follow:
-        Reasoning:
-        Response:
-
-        Example response format:
-
-        Reasoning: {self.name} is tired.
-        Response: Yes
-
-        It is important to provide Response in a single word.
-        """
+        name = self.name if name is None else name
+        new_cases = (self.model.day_infected_is_4[self.model.schedule.steps]*100)/self.model.population
+        question_prompt = self.model.prompts.render(self, name, self.get_health_string(name), new_cases)
        
         messages =  [{'role':'system', 'content':question_prompt}]
-        try:
-            output = get_completion_from_messages(messages, temperature=0)
-        except Exception as e:
-            logger.warning(f"{e}\nProgram paused. Retrying after 60s...")
-            time.sleep(60)
-            output = get_completion_from_messages(messages, temperature=0)
+        start = time.perf_counter()
+        output = self.model.backend.complete(messages, self) #retries are handled by the backend and World.query_decisions
+        self.model.llm_usage.add(calls=1, latency=time.perf_counter() - start)
         reasoning = ""
         response = ""
         try:
@@ -155,12 +160,12 @@ class Citizen(mesa.Agent):
     #    Location-decision functions       #
     ########################################
 
-    def decide_location(self):
+    def decide_location(self, decision=None):
         '''
         Agents decide whether they want to go outside on the grid or stay home.
         According to their decision, their location is updated.
         '''
-        response=self.ask_agent_stay_at_home()
+        response=self.ask_agent_stay_at_home(decision)
         
         #If agent wants to stay home
         if response is True:
@@ -194,6 +199,7 @@ class Citizen(mesa.Agent):
 
         self.agent_interaction.append(agent)
         agent.agent_interaction.append(self)
+        self.model.total_contact_rates += 2 #track global contact rate
     ########################################
     #                 Interact             #
     ########################################
@@ -229,7 +235,7 @@ class Citizen(mesa.Agent):
         if self.health_condition=="Infected":
 
             #See if there is a chance they get infected
-            if probability_threshold(infection_rate) and other.health_condition=="Susceptible":
+            if probability_threshold(infection_rate, self.model.rng) and other.health_condition=="Susceptible":
 
                 #Other is infected
                 other.health_condition="To_Be_Infected"
@@ -238,7 +244,7 @@ class Citizen(mesa.Agent):
         elif other.health_condition=="Infected":
 
             #See if there is a chance they get infected
-            if probability_threshold(infection_rate) and self.health_condition == "Susceptible":
+            if probability_threshold(infection_rate, self.model.rng) and self.health_condition == "Susceptible":
 
                 #Self is infected
                 self.health_condition="To_Be_Infected"
@@ -246,11 +252,11 @@ class Citizen(mesa.Agent):
     ################################################################################
     #                              step functions                                  #
     ################################################################################
-    def prepare_step(self):
+    def prepare_step(self, decision=None):
         '''
         Make all agents decide on their location before the step functions
         '''
-        self.decide_location()
+        self.decide_location(decision)
   
 
     def step(self):
@@ -1,14 +1,26 @@
-import openai
-from world import World
+from checkpoint import DeltaCheckpointStore
+from concurrent.futures import ProcessPoolExecutor
+from utils import set_request_limiter, LLMUsage, RateLimiter
+from multiprocessing.managers import SyncManager
+import threading
 import argparse
-import pandas as pd
-from matplotlib import pyplot as plt
+import re
 import os
 
-if __name__ == "__main__":
+#world (mesa, pandas), eval and matplotlib are imported where they are used, so that parsing arguments,
+#--help and sweep.py's parent process start without loading them
+
+
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--name", default = "GABM", help = "Name of the run to save outputs.")
     parser.add_argument("--contact_rate", default=5, type=int, help="Contact Rate")
+    parser.add_argument("--matching", default="legacy", choices=["legacy", "stub"],
+                        help="Contact matching engine. legacy samples partners agent by agent; stub pairs shuffled contact stubs in linear time.")
+    parser.add_argument("--engine", default="object", choices=["object", "vectorized"],
+                        help="Simulation engine. vectorized runs matching (always stub pairing), infection and healing as NumPy array operations.")
+    parser.add_argument("--check_counters", action="store_true",
+                        help="Recompute the incrementally maintained agent counters every day and fail if they disagree.")
     parser.add_argument("--infection_rate", default=0.1, type=float, 
                         help="Infection Rate")
     parser.add_argument("--no_init_healthy", default=98, type=int, 
@@ -19,73 +31,216 @@ if __name__ == "__main__":
                         help="Total number of days the world should run.")
     parser.add_argument("--time_to_heal", default=6,type=int, help="Time taken to heal from infection.")
     parser.add_argument("--no_of_runs", default = 1, type = int, help = "Total number of times you want to run this code.")
+    parser.add_argument("--max_concurrency", default=8, type=int,
+                        help="Maximum number of LLM requests sent at once during each day's decision phase. 1 queries agents one by one.")
+    parser.add_argument("--backend", default="openai", choices=["openai", "http", "replay", "synthetic", "surrogate", "hybrid"],
+                        help="Decision backend answering the stay-at-home prompts. The openai backend reads the OPENAI_API_KEY environment variable.")
+    parser.add_argument("--requests_per_minute", default=0, type=int,
+                        help="Requests per minute allowed by the rate limiter. With --workers, all parallel runs share this limit. 0 disables the limit.")
+    parser.add_argument("--tokens_per_minute", default=0, type=int,
+                        help="Estimated tokens per minute allowed by the rate limiter. With --workers, all parallel runs share this limit. 0 disables the limit.")
+    parser.add_argument("--max_retries", default=8, type=int,
+                        help="Retries of a failed LLM request, with exponential backoff and jitter or the server's Retry-After delay.")
+    parser.add_argument("--max_requeues", default=3, type=int,
+                        help="Times a decision that still fails after its retries is requeued behind the rest of the day's decisions.")
+    parser.add_argument("--model", default="gpt-3.5-turbo-0301", help="Chat model queried by the openai and http backends.")
+    parser.add_argument("--backend_url", default="http://127.0.0.1:8000", help="Base URL of the OpenAI-compatible server used by the http backend.")
+    parser.add_argument("--replay_from", default="", help="Checkpoint whose recorded decisions are replayed by the replay backend.")
+    parser.add_argument("--synthetic_latency", default=0.0, type=float, help="Seconds slept per decision by the synthetic backend.")
+    parser.add_argument("--surrogate_path", default="surrogate/surrogate.pkl", help="Classifier trained with surrogate.py, used by the surrogate backend.")
+    parser.add_argument("--surrogate_threshold", default=0.5, type=float, help="Stay-at-home probability at which the surrogate backend answers Yes.")
+    parser.add_argument("--escalation_backend", default="openai", choices=["openai", "http", "replay", "synthetic"],
+                        help="Backend the hybrid backend escalates uncertain or out-of-distribution decisions to.")
+    parser.add_argument("--escalation_budget", default=100, type=int, help="Maximum number of decisions the hybrid backend escalates per day.")
+    parser.add_argument("--escalation_margin", default=0.1, type=float,
+                        help="The hybrid backend escalates decisions whose surrogate probability is within this margin of --surrogate_threshold.")
+    parser.add_argument("--batch_size", default=1, type=int,
+                        help="Agents asked per LLM request. Above 1, one request carries the personas and health of up to batch_size agents and asks for a JSON list of decisions; agents missing or malformed in the answer are asked on their own. Ignored by backends that cannot batch (replay).")
+    parser.add_argument("--fidelity", action="store_true",
+                        help="Ask every agent every day. By default, days on which no agent is infected or none is susceptible skip the decision phase and agents keep their previous location.")
+    parser.add_argument("--prompt_layout", default="legacy", choices=["legacy", "prefix"],
+                        help="legacy: the original prompt. prefix: the same content with the agent's static persona, bio and instructions first and the daily health line and newspaper last, for prefix caching.")
+    parser.add_argument("--dedup_decisions", action="store_true",
+                        help="Ask the LLM once per group of agents with the same trait polarity (positive or negative in each Big Five dimension), age band, health and newspaper count, and share the representative's answer. The number of groups is reported in the llm-usage output.")
+    parser.add_argument("--dedup_age_band", default=25, type=int,
+                        help="Years of age per group with --dedup_decisions. 1 groups by exact age.")
+    parser.add_argument("--canonical_names", action="store_true",
+                        help="With --dedup_decisions, use a fixed placeholder name in the deduplicated prompts.")
+    parser.add_argument("--cache_path", default="cache/responses.sqlite",
+                        help="SQLite file used to cache LLM responses across days and runs. Pass an empty string to disable caching.")
+    parser.add_argument("--cache_size", default=100000, type=int, help="Maximum number of cached responses before least recently used ones are evicted.")
+    parser.add_argument("--mems_tail", default=0, type=int,
+                        help="Stream every decision to {checkpoint_dir}/run-N/reasoning and keep only this many days of mems in memory. 0 keeps every day in memory.")
+    parser.add_argument("--checkpoint_mode", default="full", choices=["full", "delta", "columnar"],
+                        help="full pickles the whole world every day; delta writes one base snapshot plus the daily changes to checkpoint/run-N/delta; "
+                        "columnar writes versioned .npz agent tables plus a reasoning log.")
+    parser.add_argument("--output_dir", default="output", help="Directory holding the run-N output directories.")
+    parser.add_argument("--checkpoint_queue", default=2, type=int,
+                        help="Daily checkpoints waiting to be written by the background checkpoint writer before the simulation blocks. 0 writes them synchronously.")
+    parser.add_argument("--no_plots", action="store_true",
+                        help="Do not save the SIR and home/grid figures of each run, which also skips importing matplotlib.")
+    parser.add_argument("--checkpoint_dir", default="checkpoint", help="Directory holding the run-N checkpoint directories.")
+    parser.add_argument("--seed", default=None, type=int, help="Base random seed. Run N is seeded with seed + N - 1. Unseeded runs draw a fresh seed, saved with their checkpoints; replays reuse the seed of the replayed run.")
+    parser.add_argument("--workers", default=1, type=int, help="Number of runs executed in parallel processes.")
+    parser.add_argument("--global_max_concurrency", default=0, type=int,
+                        help="Maximum number of LLM requests in flight across all parallel runs. 0 leaves only the per-run --max_concurrency limit.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip runs that have a -completed.pkl checkpoint and continue unfinished runs from their latest daily checkpoint.")
     parser.add_argument("--offset", default=0,type=int, help="offset is equal to number of days if you need to load a checkpoint")
     parser.add_argument("--load_from_run", default=0,type=int, help="equal to run # - 1 if you need to load a checkpoint (e.g. if you want to load run 2 checkpoint 8, then offset = 8, load_from_run = 1)")
+    return parser
 
-    args = parser.parse_args()
-    print(f"Parameters: {args}")
-    if os.path.exists("output") is not True:
-        os.mkdir("output")
-    if os.path.exists("checkpoint") is not True:
-        os.mkdir("checkpoint")
-    openai.api_key = "use your OpenAI API key here"
-    for i in range(args.load_from_run, args.no_of_runs):
-        print(f"--------Run - {i+1}---------")
-        checkpoint_path = f"checkpoint/run-{i+1}"
-        output_path = f"output/run-{i+1}"
-        if os.path.exists(checkpoint_path) is not True:
-            os.mkdir(checkpoint_path)
-        if os.path.exists(output_path) is not True:
-            os.mkdir(output_path)
-
-        if args.load_from_run != 0:  # Load specific checkpoint only from the specified run
-            checkpoint_file = f"checkpoint/run-{args.load_from_run+1}/{args.name}-{args.offset}.pkl"
-            if os.path.exists(checkpoint_file):
-                model = World.load_checkpoint(checkpoint_file)
-            else:
-                print(f"Warning! Checkpoint not found. Initializing new world for run {args.load_from_checkpoint+1}. This is normal if you want to continue from run {args.load_from_checkpoint+1} from scratch")
-                model = World(args, initial_healthy=args.no_init_healthy, initial_infected=args.no_init_infect,contact_rate=args.contact_rate)
+
+def find_latest_checkpoint(args, checkpoint_path):
+    '''
+    Returns (checkpoint file, day) of the latest daily checkpoint of a run, or (None, 0) if there is none
+    '''
+    if args.checkpoint_mode == "delta":
+        delta_path = checkpoint_path + "/delta"
+        if not os.path.isdir(delta_path):
+            return None, 0
+        store = DeltaCheckpointStore(delta_path)
+        days = [day for day in store.days("base") + store.days("delta") if store.has_day(day)]
+        return (delta_path, max(days)) if days else (None, 0)
+
+    extension = "npz" if args.checkpoint_mode == "columnar" else "pkl"
+    pattern = re.compile(rf"{re.escape(args.name)}-(\d+)\.{extension}$")
+    days = [int(match.group(1)) for match in map(pattern.match, os.listdir(checkpoint_path)) if match]
+    if not days:
+        return None, 0
+    return checkpoint_path + f"/{args.name}-{max(days)}.{extension}", max(days)
+
+
+def get_model(args, run, checkpoint_path):
+    '''
+    Returns (model, offset) for run: a resumed model if a checkpoint should be loaded, a new World otherwise
+    '''
+    from world import World
+    if args.resume:
+        checkpoint_file, offset = find_latest_checkpoint(args, checkpoint_path)
+        if checkpoint_file is not None:
+            print(f"Resuming run {run+1} from day {offset}")
+            return World.load_checkpoint(checkpoint_file, day=offset), offset
+
+    elif args.load_from_run != 0 and run == args.load_from_run:  # Load specific checkpoint only from the specified run
+        if args.checkpoint_mode == "delta":
+            checkpoint_file = f"{args.checkpoint_dir}/run-{args.load_from_run+1}/delta"
+            found = os.path.isdir(checkpoint_file) and DeltaCheckpointStore(checkpoint_file).has_day(args.offset)
         else:
-            model = World(args, initial_healthy=args.no_init_healthy, initial_infected=args.no_init_infect,contact_rate=args.contact_rate)
-
-        model.run_model(checkpoint_path, args.offset)
-        data = model.datacollector.get_model_vars_dataframe() #collect data from the successful run of the model
-
-        df = pd.DataFrame(data)
-        new_infections_newspaper=model.list_new_cases[:-1]
-        new_infections_newspaper[0]=model.list_new_cases[0]+model.initial_infected
-        new_infections_newspaper[1]=model.list_new_cases[1]-model.initial_infected
-        df['New Infections']=new_infections_newspaper
-        df['Cumulative Infections'] = df['New Infections'].cumsum()
-        df['Total Contact'] = model.track_contact_rate[:len(df)]
-        df["Daily New Cases Day 4"] = model.day_infected_is_4[:len(df)]
-
-        #Insert a step column function
-        df.insert(0, 'Step',range(0,len(df)))
-
-        #save data
-        df.to_csv(output_path+f"/{args.name}-data.csv")
-
-        #plot and save required figures for each run
-        plt.figure(figsize=(10,6))
-        plt.plot(df['Step'], df['Susceptible'], label="Susceptible")
-        plt.plot(df['Step'], df['Infected'], label="Infected")
-        plt.plot(df['Step'] ,df['Recovered'], label="Recovered")
-        plt.xlabel('Step')
-        plt.ylabel('# of People')
-        plt.title('SIR')
-        plt.legend()
-        plt.savefig(output_path+f'/{args.name}-SIR.png', bbox_inches='tight')
-
-
-        plt.figure(figsize=(10,6))
-        plt.plot(df['Step'], df['# Grid'], label="Citizens outside")
-        plt.plot(df['Step'], df['# Home'], label="Citizens at Home")
-        plt.xlabel('Step')
-        plt.ylabel('# of People')
-        plt.title('SIR')
-        plt.legend()
-        plt.savefig(output_path + f'/{args.name}-NumHome.png', bbox_inches='tight')
-
-        #save final checkpoint after successful run
-        model.save_checkpoint(file_path = checkpoint_path + f"/{args.name}-completed.pkl")
+            extension = "npz" if args.checkpoint_mode == "columnar" else "pkl"
+            checkpoint_file = f"{args.checkpoint_dir}/run-{args.load_from_run+1}/{args.name}-{args.offset}.{extension}"
+            found = os.path.exists(checkpoint_file)
+        if found:
+            return World.load_checkpoint(checkpoint_file, day=args.offset), args.offset
+        print(f"Warning! Checkpoint not found. Initializing new world for run {args.load_from_run+1}. This is normal if you want to continue from run {args.load_from_run+1} from scratch")
+
+    return World(args, initial_healthy=args.no_init_healthy, initial_infected=args.no_init_infect,contact_rate=args.contact_rate), 0
+
+
+def save_outputs(model, args, output_path):
+    '''
+    Saves the data frame and figures (unless args.no_plots) of a finished run to output_path
+    '''
+    from eval import run_stats
+    import pandas as pd
+    df = run_stats(model)
+
+    #save data
+    df.to_csv(output_path+f"/{args.name}-data.csv")
+
+    #LLM calls, tokens, retries, cache hits and latency of each day, with the totals of the run
+    usage = pd.DataFrame(model.daily_llm_usage, columns=LLMUsage.FIELDS)
+    totals = usage.agg(["sum"]).rename(index={"sum": "Total"})
+    pd.concat([usage, totals]).to_csv(output_path+f"/{args.name}-llm-usage.csv", index_label="Day")
+
+    if args.no_plots:
+        return df
+
+    #plot and save required figures for each run
+    from matplotlib import pyplot as plt
+    plt.figure(figsize=(10,6))
+    plt.plot(df['Step'], df['Susceptible'], label="Susceptible")
+    plt.plot(df['Step'], df['Infected'], label="Infected")
+    plt.plot(df['Step'] ,df['Recovered'], label="Recovered")
+    plt.xlabel('Step')
+    plt.ylabel('# of People')
+    plt.title('SIR')
+    plt.legend()
+    plt.savefig(output_path+f'/{args.name}-SIR.png', bbox_inches='tight')
+
+
+    plt.figure(figsize=(10,6))
+    plt.plot(df['Step'], df['# Grid'], label="Citizens outside")
+    plt.plot(df['Step'], df['# Home'], label="Citizens at Home")
+    plt.xlabel('Step')
+    plt.ylabel('# of People')
+    plt.title('SIR')
+    plt.legend()
+    plt.savefig(output_path + f'/{args.name}-NumHome.png', bbox_inches='tight')
+    plt.close("all")
+    return df
+
+
+class LimiterManager(SyncManager):
+    '''
+    Manager process holding the limiters shared by parallel runs: its BoundedSemaphore and RateLimiter
+    proxies are used by every worker process, so the limits hold across runs
+    '''
+
+LimiterManager.register("RateLimiter", RateLimiter)
+
+
+def run_replicate(args, run, limiter=None, rate_limiter=None):
+    '''
+    Runs (or resumes) run number run in its own {output_dir}/run-N and {checkpoint_dir}/run-N directories.
+    limiter: semaphore shared by all parallel runs to bound the LLM requests in flight
+    rate_limiter: RateLimiter shared by all parallel runs, used instead of the World's own
+    '''
+    print(f"--------Run - {run+1}---------")
+    checkpoint_path = f"{args.checkpoint_dir}/run-{run+1}"
+    output_path = f"{args.output_dir}/run-{run+1}"
+    os.makedirs(checkpoint_path, exist_ok=True)
+    os.makedirs(output_path, exist_ok=True)
+
+    #Per-run seeds for the World's generators, so replicates do not share random streams
+    args = argparse.Namespace(**{**vars(args), "seed": None if args.seed is None else args.seed + run})
+    set_request_limiter(limiter, rate_limiter)
+
+    model, offset = get_model(args, run, checkpoint_path)
+    model.run_model(checkpoint_path, offset)
+    df = save_outputs(model, args, output_path)
+
+    #save final checkpoint after successful run
+    model.save_checkpoint(file_path = checkpoint_path + f"/{args.name}-completed.pkl")
+    return df
+
+
+def run_replicates(jobs, workers=1, global_max_concurrency=0, requests_per_minute=0, tokens_per_minute=0):
+    '''
+    Runs the given (args, run) jobs, in workers parallel processes if more than one.
+    Parallel runs share one bucket of requests_per_minute and tokens_per_minute (0 for no limit),
+    so the limits apply to all runs together rather than to each of them.
+    Returns the data frame of every job, in job order.
+    Used in main and sweep.py
+    '''
+    if workers <= 1:
+        limiter = threading.BoundedSemaphore(global_max_concurrency) if global_max_concurrency > 0 else None
+        return [run_replicate(args, run, limiter) for args, run in jobs]
+
+    with LimiterManager() as manager:
+        limiter = manager.BoundedSemaphore(global_max_concurrency) if global_max_concurrency > 0 else None
+        rate_limiter = manager.RateLimiter(requests_per_minute, tokens_per_minute) if requests_per_minute or tokens_per_minute else None
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_replicate, args, run, limiter, rate_limiter) for args, run in jobs]
+            return [future.result() for future in futures]
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    print(f"Parameters: {args}")
+
+    runs = list(range(args.load_from_run, args.no_of_runs))
+    if args.resume:
+        runs = [run for run in runs if not os.path.exists(f"{args.checkpoint_dir}/run-{run+1}/{args.name}-completed.pkl")]
+        print(f"Unfinished runs: {[run+1 for run in runs]}")
+    run_replicates([(args, run) for run in runs], args.workers, args.global_max_concurrency, args.requests_per_minute, args.tokens_per_minute)
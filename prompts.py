@@ -0,0 +1,200 @@
+import json
+import re
+
+#Prompt layouts: "legacy" is the original prompt, "prefix" puts everything that stays the same for an agent first,
+#so that provider-side or local-server prefix caching applies, and the health line and newspaper last
+PROMPT_LAYOUTS = ["legacy", "prefix"]
+
+#Stand-ins for the fields filled in every day, used to split a compiled prompt into its static chunks
+_HEALTH, _CASES = "\x00health\x00", "\x00cases\x00"
+
+
+def legacy_prompt(name, age, traits, health_string, new_cases):
+    '''
+    Stay-at-home prompt as originally written in Citizen.get_response_and_reasoning
+    '''
+    return f"""
+        You are {name}. You are {age} years old. 
+       
+        Your traits are given below:
+        {traits}
+        
+        Your basic bio is below:
+        {name} lives in the town of Dewberry Hollow. {name} likes the town and has friends who also live there. {name} has a job and goes to the office for work everyday.
+        
+        I will provide {name}'s relevant memories here:
+        {health_string}
+        {name} knows about the Catasat virus spreading across the country. It is an infectious disease that spreads from human to human contact via an airborne virus. The deadliness of the virus is unknown. Scientists are warning about a potential epidemic.
+        {name} checks the newspaper and finds that {new_cases}% of Dewberry Hollow's population caught new infections of the Catasat virus yesterday.
+        {name} goes to work to earn money to support {name}'s self.
+       
+        Based on the provided memories, should {name} stay at home for the entire day? Please provide your reasoning.
+
+        If the answer is "Yes," please state your reasoning as "Reasoning: [explanation]." 
+        If the answer is "No," please state your reasoning as "Reasoning: [explanation]."
+        
+        The format should be as follow:
+        Reasoning:
+        Response:
+
+        Example response format:
+
+        Reasoning: {name} is tired.
+        Response: Yes
+
+        It is important to provide Response in a single word.
+        """
+
+
+def prefix_prompt(name, age, traits, health_string, new_cases):
+    '''
+    The legacy prompt's content reordered so that only its last lines change from day to day
+    '''
+    return f"""You are {name}. You are {age} years old.
+
+Your traits are given below:
+{traits}
+
+Your basic bio is below:
+{name} lives in the town of Dewberry Hollow. {name} likes the town and has friends who also live there. {name} has a job and goes to the office for work everyday.
+
+Based on the memories provided at the end, should {name} stay at home for the entire day? Please provide your reasoning.
+
+If the answer is "Yes," please state your reasoning as "Reasoning: [explanation]." 
+If the answer is "No," please state your reasoning as "Reasoning: [explanation]."
+
+The format should be as follow:
+Reasoning:
+Response:
+
+Example response format:
+
+Reasoning: {name} is tired.
+Response: Yes
+
+It is important to provide Response in a single word.
+
+I will provide {name}'s relevant memories here:
+{name} knows about the Catasat virus spreading across the country. It is an infectious disease that spreads from human to human contact via an airborne virus. The deadliness of the virus is unknown. Scientists are warning about a potential epidemic.
+{name} goes to work to earn money to support {name}'s self.
+{health_string}
+{name} checks the newspaper and finds that {new_cases}% of Dewberry Hollow's population caught new infections of the Catasat virus yesterday.
+"""
+
+
+#Line of each resident in a batched prompt, also used by backends.synthetic_completion to answer batched prompts
+BATCH_RESIDENT = "Resident {number}: {name}, {age} years old. Traits: {traits}. {health_string}"
+BATCH_RESIDENT_PATTERN = re.compile(r"^Resident (\d+): (.*)$", re.MULTILINE)
+
+
+def batch_prompt(residents, new_cases):
+    '''
+    Stay-at-home prompt asking for the decisions of several agents at once.
+    residents: (name, age, traits, health_string) of each agent, numbered from 1 in the prompt
+    The answer is parsed by parse_batch_response.
+    '''
+    lines = "\n".join(BATCH_RESIDENT.format(number=number, name=name, age=age, traits=traits, health_string=health_string)
+                      for number, (name, age, traits, health_string) in enumerate(residents, 1))
+    return f"""You will decide, for each of the {len(residents)} residents of the town of Dewberry Hollow listed below, whether they stay at home for the entire day.
+
+Every resident likes the town and has friends who also live there. Every resident has a job, goes to the office for work everyday and goes to work to earn money to support themselves.
+Every resident knows about the Catasat virus spreading across the country. It is an infectious disease that spreads from human to human contact via an airborne virus. The deadliness of the virus is unknown. Scientists are warning about a potential epidemic.
+Every resident checks the newspaper and finds that {new_cases: .1f}% of Dewberry Hollow's population caught new infections of the Catasat virus yesterday.
+
+Each resident's name, age, traits and health are given below:
+{lines}
+
+Decide for each resident separately, based on that resident's own traits and health. Answer with a JSON list holding one object per resident, in the order above, and nothing else:
+[{{"resident": 1, "reasoning": "[explanation]", "response": "Yes"}}, {{"resident": 2, "reasoning": "[explanation]", "response": "No"}}]
+
+It is important to provide "response" as the single word "Yes" or "No".
+"""
+
+
+def parse_batch_response(output, count):
+    '''
+    (reasoning, response) of each of the count residents of a batch_prompt answer, None for residents
+    missing from the answer or whose entry is malformed (so they can be asked on their own instead).
+    Tolerates text or code fences around the JSON list, and falls back to reading the entries one by one
+    when the list as a whole is not valid JSON.
+    '''
+    output = output or ""
+    start, end = output.find("["), output.rfind("]")
+    entries = None
+    if start != -1 and end > start:
+        try:
+            entries = json.loads(output[start:end+1])
+        except ValueError:
+            pass
+    if not isinstance(entries, list):
+        entries = []
+        for match in re.finditer(r"\{[^{}]*\}", output):
+            try:
+                entries.append(json.loads(match.group(0)))
+            except ValueError:
+                continue
+
+    decisions = [None] * count
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        number, reasoning, response = entry.get("resident"), entry.get("reasoning"), entry.get("response")
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            continue
+        if not (1 <= number <= count) or decisions[number-1] is not None or not isinstance(reasoning, str) or not isinstance(response, str):
+            continue
+        response = response.strip().split(".", 1)[0]
+        if response.lower() not in ("yes", "no") or not reasoning.strip():
+            continue
+        decisions[number-1] = (reasoning.strip(), response)
+    return decisions
+
+
+class PromptCompiler:
+    '''
+    Builds stay-at-home prompts from per-agent templates compiled once: the static chunks of the prompt
+    around the health line and the newspaper's percentage of new cases, which are the only parts filled in per day.
+    Compiled templates and health strings are not pickled with the World; they are rebuilt on first use.
+    Used in Citizen.get_response_and_reasoning and Citizen.get_health_string
+    '''
+    def __init__(self, layout="legacy"):
+        if layout not in PROMPT_LAYOUTS:
+            raise ValueError(f"Unknown prompt layout '{layout}'. Choose from {PROMPT_LAYOUTS}.")
+        self.layout = layout
+        self.templates = {} #(agent id, name) -> (chunk before the health line, chunk before the percentage, rest)
+        self.health_string_cache = {} #name -> health strings of get_health_string
+
+    def compile(self, agent, name):
+        build = legacy_prompt if self.layout == "legacy" else prefix_prompt
+        head, rest = build(name, agent.age, agent.traits, _HEALTH, _CASES).split(_HEALTH)
+        middle, tail = rest.split(_CASES)
+        self.templates[(agent.unique_id, name)] = (head, middle, tail)
+        return head, middle, tail
+
+    def compile_all(self, agents):
+        for agent in agents:
+            self.compile(agent, agent.name)
+
+    def render(self, agent, name, health_string, new_cases):
+        '''
+        Prompt of agent (asked as name) with the given health line and percentage of new cases
+        '''
+        template = self.templates.get((agent.unique_id, name))
+        head, middle, tail = template if template is not None else self.compile(agent, name)
+        return f"{head}{health_string}{middle}{new_cases: .1f}{tail}"
+
+    def health_strings(self, name):
+        strings = self.health_string_cache.get(name)
+        if strings is None:
+            strings = self.health_string_cache[name] = (f"{name} feels normal.",
+                                                        f"{name} has a light cough.",
+                                                        f"{name} has a fever and a cough.")
+        return strings
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["templates"] = {}
+        state["health_string_cache"] = {}
+        return state
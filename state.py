@@ -0,0 +1,175 @@
+import numpy as np
+
+#Health codes stored in AgentState.health
+SUSCEPTIBLE = 0
+TO_BE_INFECTED = 1
+INFECTED = 2
+RECOVERED = 3
+HEALTH_CONDITIONS = ["Susceptible", "To_Be_Infected", "Infected", "Recovered"]
+HEALTH_CODES = {condition: code for code, condition in enumerate(HEALTH_CONDITIONS)}
+
+#day_infected value standing for None (agent is not infected)
+NOT_INFECTED = -1
+
+#Symptoms in Citizen.get_health_string, coded as returned by AgentState.symptoms
+SYMPTOMS = ["feels normal", "has a light cough", "has a fever and a cough"]
+
+
+class AgentState:
+    '''
+    Struct-of-arrays store of every agent's health and location, indexed by unique_id.
+    Citizen.health_condition, Citizen.day_infected and Citizen.location are views into these arrays.
+    health: int8 health codes (see HEALTH_CONDITIONS)
+    day_infected: int16 number of days infected, NOT_INFECTED if the agent is not infected
+    on_grid: True if the agent's location is "grid", False if "home"
+    The arrays must be changed through the set_* methods and the batched operations below,
+    which keep health_counts, num_on_grid and num_day_4 up to date for the datacollector.
+    '''
+    def __init__(self, n):
+        self.health = np.full(n, SUSCEPTIBLE, dtype=np.int8)
+        self.day_infected = np.full(n, NOT_INFECTED, dtype=np.int16)
+        self.on_grid = np.ones(n, dtype=bool)
+
+        #Counters maintained on every state transition
+        self.health_counts = np.zeros(len(HEALTH_CONDITIONS), dtype=np.int64)
+        self.health_counts[SUSCEPTIBLE] = n
+        self.num_on_grid = n
+        self.num_day_4 = 0 #agents infected for 4 days, reported in the newspaper
+
+    def count(self, code):
+        return int(self.health_counts[code])
+
+    def set_health(self, idx, code):
+        self.health_counts[self.health[idx]] -= 1
+        self.health_counts[code] += 1
+        self.health[idx] = code
+
+    def set_day_infected(self, idx, day):
+        self.num_day_4 += int(day == 4) - int(self.day_infected[idx] == 4)
+        self.day_infected[idx] = day
+
+    def set_on_grid(self, idx, on_grid):
+        self.num_on_grid += int(on_grid) - int(self.on_grid[idx])
+        self.on_grid[idx] = on_grid
+
+    def set_locations(self, idx, on_grid):
+        '''
+        Batched set_on_grid for an array of distinct agent indices
+        '''
+        self.num_on_grid += int(np.count_nonzero(on_grid)) - int(np.count_nonzero(self.on_grid[idx]))
+        self.on_grid[idx] = on_grid
+
+    def compute_counters(self):
+        return {"health_counts": np.bincount(self.health, minlength=len(HEALTH_CONDITIONS)).tolist(),
+                "num_on_grid": int(np.count_nonzero(self.on_grid)),
+                "num_day_4": int(np.count_nonzero(self.day_infected == 4))}
+
+    def recount(self):
+        '''
+        Rebuilds every counter from the arrays, after the arrays were restored directly from a checkpoint
+        '''
+        counters = self.compute_counters()
+        self.health_counts = np.array(counters["health_counts"], dtype=np.int64)
+        self.num_on_grid = counters["num_on_grid"]
+        self.num_day_4 = counters["num_day_4"]
+
+    def check_counters(self):
+        '''
+        Recomputes every counter from the arrays and raises RuntimeError on a mismatch.
+        Used by World.step when check_counters is enabled.
+        '''
+        expected = self.compute_counters()
+        actual = {"health_counts": self.health_counts.tolist(),
+                  "num_on_grid": self.num_on_grid,
+                  "num_day_4": self.num_day_4}
+        if expected != actual:
+            raise RuntimeError(f"Agent state counters are out of sync: expected {expected}, got {actual}")
+
+    def symptoms(self, idx=slice(None)):
+        '''
+        Index into SYMPTOMS of each agent's health string (see Citizen.get_health_string)
+        '''
+        infected = self.health[idx] == INFECTED
+        day = self.day_infected[idx]
+        codes = np.zeros(len(day), dtype=np.int8)
+        codes[infected & ((day == 3) | (day == 6))] = 1
+        codes[infected & ((day == 4) | (day == 5))] = 2
+        return codes
+
+    def infect(self, edges, infection_rate, rng):
+        '''
+        Batched version of Citizen.interact/Citizen.infect for a whole day.
+        edges: (m, 2) array of contact pairs, rng: NumPy generator of the World. Like the object engine, every contact is rolled once
+        from each side, so a susceptible agent meeting an infected one gets two chances of infection.
+        Returns the number of agents set to To_Be_Infected.
+        '''
+        if len(edges) == 0:
+            return 0
+        health_a = self.health[edges[:, 0]]
+        health_b = self.health[edges[:, 1]]
+        a_infects_b = (health_a == INFECTED) & (health_b == SUSCEPTIBLE)
+        b_infects_a = (health_b == INFECTED) & (health_a == SUSCEPTIBLE)
+        targets = np.concatenate([edges[a_infects_b, 1], edges[b_infects_a, 0]])
+
+        infected = (rng.random((len(targets), 2)) < infection_rate).any(axis=1)
+        new_infections = np.unique(targets[infected])
+        self.health[new_infections] = TO_BE_INFECTED
+        self.health_counts[SUSCEPTIBLE] -= len(new_infections)
+        self.health_counts[TO_BE_INFECTED] += len(new_infections)
+        return len(new_infections)
+
+    def update_day(self, time_to_heal=6):
+        '''
+        Batched version of utils.update_day for every agent.
+        Returns the number of new infections and the number of agents who healed.
+        '''
+        new = self.health == TO_BE_INFECTED
+        self.health[new] = INFECTED
+        self.day_infected[new] = 0
+
+        infected = self.health == INFECTED
+        self.day_infected[infected] += 1
+
+        healed = infected & (self.day_infected > time_to_heal)
+        self.health[healed] = RECOVERED
+        self.day_infected[healed] = NOT_INFECTED
+
+        num_new, num_healed = int(np.count_nonzero(new)), int(np.count_nonzero(healed))
+        self.health_counts[TO_BE_INFECTED] -= num_new
+        self.health_counts[INFECTED] += num_new - num_healed
+        self.health_counts[RECOVERED] += num_healed
+        self.num_day_4 = int(np.count_nonzero(self.day_infected[infected] == 4))
+        return num_new, num_healed
+
+
+def pair_contact_stubs(agent_idx, contact_rate, rng, max_rounds=10):
+    '''
+    Vectorized stub pairing used by the vectorized engine (see World.pair_contact_stubs).
+    Every index in agent_idx gets contact_rate stubs, which are shuffled with rng and paired up.
+    Self-pairs and repeated pairs are reshuffled for up to max_rounds rounds.
+    Returns an (m, 2) array of contact pairs.
+    '''
+    stubs = np.repeat(agent_idx, max(contact_rate, 0))
+    n = int(agent_idx.max()) + 1 if len(agent_idx) else 0
+    edges = np.empty((0, 2), dtype=np.int64)
+    edge_keys = np.empty(0, dtype=np.int64) #sorted keys of the accepted pairs
+
+    for _ in range(max_rounds):
+        if len(stubs) < 2:
+            break
+        stubs = rng.permutation(stubs)
+        pairs = stubs[:len(stubs) - len(stubs) % 2].reshape(-1, 2).astype(np.int64)
+        keys = np.minimum(pairs[:, 0], pairs[:, 1]) * n + np.maximum(pairs[:, 0], pairs[:, 1])
+
+        positions = np.searchsorted(edge_keys, keys)
+        seen = edge_keys[np.minimum(positions, len(edge_keys) - 1)] == keys if len(edge_keys) else np.zeros(len(keys), dtype=bool)
+        first = np.zeros(len(pairs), dtype=bool)
+        first[np.unique(keys, return_index=True)[1]] = True #Only the first copy of a repeated pair is kept
+        valid = (pairs[:, 0] != pairs[:, 1]) & ~seen & first
+
+        new_keys = keys[valid]
+        order = np.argsort(new_keys)
+        edge_keys = np.insert(edge_keys, np.searchsorted(edge_keys, new_keys[order]), new_keys[order])
+        edges = np.concatenate([edges, pairs[valid]])
+        stubs = np.concatenate([pairs[~valid].ravel(), stubs[len(pairs) * 2:]])
+    return edges
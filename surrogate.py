@@ -0,0 +1,215 @@
+from world import World
+from backends import DecisionBackend
+from eval import build_panel, agent_table, FEATURES, STATIC_FEATURES
+from state import SYMPTOMS
+from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.impute import SimpleImputer
+from sklearn import metrics
+import argparse
+import logging
+import pickle
+import json
+import os
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+def day_features(static, symptoms, new_case_alert):
+    '''
+    eval.FEATURES rows from static agent features, SYMPTOMS codes and the newspaper's new-case fraction
+    '''
+    return np.column_stack([static, np.eye(len(SYMPTOMS))[symptoms], np.full(len(static), new_case_alert)])
+
+
+def new_case_alert(model, step):
+    '''
+    Fraction of the population reported in the newspaper of the stay-at-home prompt at step
+    '''
+    return model.day_infected_is_4[step] / model.population
+
+
+def decision_features(model):
+    '''
+    Features and stay-at-home labels (1 for "Yes") of every decision recorded in a finished run (see eval.build_panel).
+    Decisions answered by a surrogate are left out, so a surrogate is never trained on its own answers,
+    and so are the decisions planned without asking anyone and those copied within deduplication groups, which build_panel drops.
+    '''
+    panel = build_panel(model)
+    panel = panel[panel["source"] != "surrogate"]
+    return panel[FEATURES].to_numpy(dtype=float), panel["Response"].to_numpy()
+
+
+def load_training_data(checkpoint_paths):
+    '''
+    Stacks decision_features of the runs saved at checkpoint_paths
+    '''
+    features = [decision_features(World.load_checkpoint(path)) for path in checkpoint_paths]
+    return np.concatenate([X for X, _ in features]), np.concatenate([y for _, y in features])
+
+
+def train_surrogate(X, y, kind="logistic"):
+    '''
+    Fits a stay-at-home classifier: "logistic" regression on standardized features, or "gbm" gradient boosting
+    '''
+    if kind == "logistic":
+        classifier = make_pipeline(SimpleImputer(strategy="constant", fill_value=0), StandardScaler(), LogisticRegression(max_iter=1000))
+    elif kind == "gbm":
+        classifier = HistGradientBoostingClassifier()
+    else:
+        raise ValueError(f"Unknown surrogate kind '{kind}'. Choose 'logistic' or 'gbm'.")
+    return classifier.fit(X, y)
+
+
+def save_surrogate(classifier, X, model_path):
+    '''
+    Pickles the classifier with the range of its training features, used to detect out-of-distribution agents
+    '''
+    os.makedirs(os.path.dirname(model_path) or ".", exist_ok=True)
+    with open(model_path, "wb") as file:
+        pickle.dump({"classifier": classifier, "features": FEATURES,
+                     "low": np.nanmin(X, axis=0), "high": np.nanmax(X, axis=0)}, file)
+
+
+def calibration_report(classifier, X, y, bins=10):
+    '''
+    Reliability table (mean predicted probability against the observed stay-at-home rate per probability bin)
+    and summary metrics of the classifier on held-out decisions
+    '''
+    probability = classifier.predict_proba(X)[:, 1]
+    bin_idx = np.minimum((probability * bins).astype(int), bins - 1)
+    table = pd.DataFrame({"bin": bin_idx, "predicted": probability, "observed": y}).groupby("bin").agg(
+        count=("observed", "size"), predicted=("predicted", "mean"), observed=("observed", "mean")).reset_index()
+    table["lower"] = table["bin"] / bins
+    table["upper"] = (table["bin"] + 1) / bins
+
+    report = {"decisions": len(y),
+              "stay_home_rate": float(np.mean(y)),
+              "accuracy": float(np.mean((probability >= 0.5) == y)),
+              "brier": float(metrics.brier_score_loss(y, probability)),
+              "log_loss": float(metrics.log_loss(y, probability, labels=[0, 1])),
+              "expected_calibration_error": float(np.sum(table["count"] * np.abs(table["predicted"] - table["observed"])) / len(y))}
+    if len(np.unique(y)) == 2:
+        report["roc_auc"] = float(metrics.roc_auc_score(y, probability))
+    return table[["bin", "lower", "upper", "count", "predicted", "observed"]], report
+
+
+class SurrogateBackend(DecisionBackend):
+    '''
+    Answers stay-at-home prompts with a classifier saved by save_surrogate instead of an LLM.
+    decide_day answers every agent of a day at once from the World's state arrays;
+    agents stay home when their predicted probability is at least threshold.
+    '''
+    vectorized = True
+    source = "surrogate"
+
+    def __init__(self, model_path, threshold=0.5):
+        self.model_path = model_path
+        self.threshold = threshold
+        with open(model_path, "rb") as file:
+            saved = pickle.load(file)
+        self.classifier = saved["classifier"]
+        self.low, self.high = saved["low"], saved["high"]
+        self.static = None #static features of the agents of the World being simulated, computed on first use
+
+    def features(self, model, idx):
+        if self.static is None or len(self.static) != model.population:
+            self.static = agent_table(model)[STATIC_FEATURES].to_numpy(dtype=float)
+        return day_features(self.static[idx], model.state.symptoms(idx), new_case_alert(model, model.schedule.steps))
+
+    def predict(self, model, idx):
+        return self.classifier.predict_proba(self.features(model, idx))[:, 1]
+
+    def out_of_distribution(self, X):
+        '''
+        True for rows with a feature outside the range seen in training
+        '''
+        return ((X < self.low) | (X > self.high)).any(axis=1)
+
+    def answer(self, probability):
+        response = "Yes" if probability >= self.threshold else "No"
+        return f"Surrogate stay-at-home probability is {probability:.2f}.", response, SurrogateBackend.source
+
+    def decide_day(self, model):
+        '''
+        (reasoning, response, source) of every agent in schedule order, like World.get_decisions
+        '''
+        idx = np.array([agent.unique_id for agent in model.schedule.agents])
+        return [self.answer(probability) for probability in self.predict(model, idx)]
+
+    def complete(self, messages, agent):
+        reasoning, response, _ = self.answer(self.predict(agent.model, np.array([agent.unique_id]))[0])
+        return f"Reasoning: {reasoning}\nResponse: {response}"
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["static"] = None
+        return state
+
+
+class HybridBackend(SurrogateBackend):
+    '''
+    Answers with the surrogate and escalates up to budget agents a day to the llm backend:
+    first those whose features are outside the training range, then those whose predicted
+    probability is closest to the threshold, as long as it is within margin of it.
+    '''
+    def __init__(self, model_path, llm, budget=100, margin=0.1, threshold=0.5):
+        super().__init__(model_path, threshold)
+        self.llm = llm
+        self.budget = budget
+        self.margin = margin
+
+    @property
+    def source(self): #decisions queried through complete() are answered by the llm backend
+        return self.llm.source
+
+    @property
+    def supports_batching(self):
+        return self.llm.supports_batching
+
+    def decide_day(self, model):
+        agents = model.schedule.agents
+        X = self.features(model, np.array([agent.unique_id for agent in agents]))
+        probability = self.classifier.predict_proba(X)[:, 1]
+        decisions = [self.answer(p) for p in probability]
+
+        distance = np.abs(probability - self.threshold)
+        outside = self.out_of_distribution(X)
+        candidates = np.flatnonzero(outside | (distance < self.margin))
+        escalated = candidates[np.lexsort((distance[candidates], ~outside[candidates]))][:max(self.budget, 0)]
+        answers = model.query_decisions([agents[idx] for idx in escalated])
+        for idx, (reasoning, response) in zip(escalated, answers):
+            decisions[idx] = (reasoning, response, self.llm.source)
+        logger.info(f"Escalated {len(escalated)} of {len(candidates)} uncertain or out-of-distribution decisions to the LLM")
+        return decisions
+
+    def complete(self, messages, agent):
+        return self.llm.complete(messages, agent)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train a stay-at-home surrogate on the mems of finished runs "
+                                     "and report its calibration on held-out runs.")
+    parser.add_argument("--train", nargs="+", required=True, help="Checkpoints of the runs to train on.")
+    parser.add_argument("--holdout", nargs="*", default=[], help="Checkpoints of held-out LLM runs for the calibration report.")
+    parser.add_argument("--kind", default="logistic", choices=["logistic", "gbm"], help="Classifier to train.")
+    parser.add_argument("--model_path", default="surrogate/surrogate.pkl", help="Where to save the trained classifier.")
+    parser.add_argument("--bins", default=10, type=int, help="Number of probability bins in the calibration report.")
+    args = parser.parse_args()
+
+    X, y = load_training_data(args.train)
+    classifier = train_surrogate(X, y, args.kind)
+    save_surrogate(classifier, X, args.model_path)
+    print(f"Trained a {args.kind} surrogate on {len(y)} decisions, saved to {args.model_path}")
+
+    if args.holdout:
+        table, report = calibration_report(classifier, *load_training_data(args.holdout), bins=args.bins)
+        stem = os.path.splitext(args.model_path)[0]
+        table.to_csv(f"{stem}-calibration.csv", index=False)
+        with open(f"{stem}-calibration.json", "w") as file:
+            json.dump(report, file, indent=2)
+        print(table.to_string(index=False))
+        print(json.dumps(report, indent=2))
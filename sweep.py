@@ -0,0 +1,115 @@
+from main import get_parser, run_replicates
+import argparse
+import itertools
+import copy
+import os
+import numpy as np
+import pandas as pd
+
+#main.py hyperparameters a sweep can vary, with their types
+SWEEP_PARAMETERS = {"contact_rate": int, "infection_rate": float, "no_init_healthy": int, "no_init_infect": int, "no_days": int}
+
+
+def parse_values(spec):
+    '''
+    Parses "name=v1,v2,..." into (name, [values])
+    '''
+    name, values = spec.split("=", 1)
+    if name not in SWEEP_PARAMETERS:
+        raise ValueError(f"Cannot sweep over '{name}'. Choose from {list(SWEEP_PARAMETERS)}.")
+    return name, [SWEEP_PARAMETERS[name](value) for value in values.split(",")]
+
+
+def parse_range(spec):
+    '''
+    Parses "name=low:high" into (name, low, high)
+    '''
+    name, bounds = spec.split("=", 1)
+    if name not in SWEEP_PARAMETERS:
+        raise ValueError(f"Cannot sweep over '{name}'. Choose from {list(SWEEP_PARAMETERS)}.")
+    low, high = bounds.split(":")
+    return name, float(low), float(high)
+
+
+def grid_points(specs):
+    '''
+    Every combination of the values given as "name=v1,v2,..."
+    '''
+    parsed = [parse_values(spec) for spec in specs]
+    names = [name for name, _ in parsed]
+    return [dict(zip(names, combination)) for combination in itertools.product(*[values for _, values in parsed])]
+
+
+def latin_hypercube_points(specs, n, seed=None):
+    '''
+    n Latin-hypercube samples over the ranges given as "name=low:high":
+    each range is split into n strata and every stratum is sampled exactly once.
+    '''
+    rng = np.random.RandomState(seed)
+    points = [{} for _ in range(n)]
+    for name, low, high in map(parse_range, specs):
+        samples = (rng.permutation(n) + rng.rand(n)) / n
+        for point, sample in zip(points, low + samples * (high - low)):
+            point[name] = SWEEP_PARAMETERS[name](round(sample) if SWEEP_PARAMETERS[name] is int else sample)
+    return points
+
+
+def run_sweep(points, base_args, sweep_dir, workers=1, global_max_concurrency=0):
+    '''
+    Runs base_args.no_of_runs replicates of every point, all scheduled on one process pool,
+    and returns one table with the daily data of every run, tagged with its point and parameters.
+    Runs share base_args.cache_path, so identical prompts are only sent once across the sweep,
+    and the requests and tokens per minute of base_args, which hold for the whole sweep.
+    '''
+    jobs = []
+    for idx, point in enumerate(points):
+        args = copy.deepcopy(base_args)
+        for name, value in point.items():
+            setattr(args, name, value)
+        args.output_dir = os.path.join(sweep_dir, f"point-{idx}", "output")
+        args.checkpoint_dir = os.path.join(sweep_dir, f"point-{idx}", "checkpoint")
+        for run in range(args.no_of_runs):
+            jobs.append((idx, args, run))
+
+    #With --resume, finished runs are read back from their outputs instead of being run again
+    pending = [job for job, (_, args, run) in enumerate(jobs)
+               if not (base_args.resume and os.path.exists(f"{args.checkpoint_dir}/run-{run+1}/{args.name}-completed.pkl"))]
+    results = dict(zip(pending, run_replicates([jobs[job][1:] for job in pending], workers, global_max_concurrency,
+                                               base_args.requests_per_minute, base_args.tokens_per_minute)))
+
+    tables = []
+    for job, (idx, args, run) in enumerate(jobs):
+        if job in results:
+            df = results[job]
+        else:
+            df = pd.read_csv(f"{args.output_dir}/run-{run+1}/{args.name}-data.csv", index_col=0)
+        df = df.copy()
+        df.insert(0, "Run", run + 1)
+        for name in reversed(list(points[idx])):
+            df.insert(0, name, points[idx][name])
+        df.insert(0, "Point", idx)
+        tables.append(df)
+    return pd.concat(tables, ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parameter sweep over main.py hyperparameters. "
+                                     "Arguments not listed here are passed on to main.py for every run.")
+    parser.add_argument("--sweep_dir", default="sweep", help="Directory holding the outputs and checkpoints of every point.")
+    parser.add_argument("--grid", nargs="+", default=[], help="Grid over the given values, e.g. contact_rate=2,5,10 infection_rate=0.05,0.1")
+    parser.add_argument("--lhs", nargs="+", default=[], help="Latin-hypercube ranges, e.g. contact_rate=2:10 infection_rate=0.05:0.2")
+    parser.add_argument("--samples", default=10, type=int, help="Number of Latin-hypercube samples.")
+    sweep_args, main_args = parser.parse_known_args()
+    base_args = get_parser().parse_args(main_args)
+
+    if bool(sweep_args.grid) == bool(sweep_args.lhs):
+        parser.error("Give exactly one of --grid or --lhs.")
+    if sweep_args.grid:
+        points = grid_points(sweep_args.grid)
+    else:
+        points = latin_hypercube_points(sweep_args.lhs, sweep_args.samples, base_args.seed)
+    print(f"Sweeping {len(points)} points x {base_args.no_of_runs} runs")
+
+    results = run_sweep(points, base_args, sweep_args.sweep_dir, base_args.workers, base_args.global_max_concurrency)
+    os.makedirs(sweep_args.sweep_dir, exist_ok=True)
+    results.to_csv(os.path.join(sweep_args.sweep_dir, f"{base_args.name}-sweep-results.csv"), index=False)
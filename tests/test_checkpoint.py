@@ -0,0 +1,65 @@
+import os
+import pytest
+from main import get_parser
+from world import World
+
+
+def make_world(mode, seed=0):
+    args = get_parser().parse_args(["--backend", "synthetic", "--cache_path", "", "--checkpoint_mode", mode, "--no_days", "20",
+                                    "--infection_rate", "0.1", "--seed", str(seed)])
+    return World(args, initial_healthy=190, initial_infected=10, contact_rate=5)
+
+
+def outcome(model):
+    personas = sorted((agent.unique_id, agent.name, agent.age) for agent in model.schedule.agents)
+    return model.list_new_cases, model.day_infected_is_4, model.datacollector.model_vars, personas
+
+
+@pytest.mark.parametrize("mode, checkpoint", [("full", "GABM-5.pkl"), ("delta", "delta"), ("columnar", "GABM-5.npz")])
+def test_resume_reproduces_run(tmp_path, mode, checkpoint):
+    for directory in ["run", "resumed"]:
+        os.makedirs(tmp_path / directory)
+    model = make_world(mode)
+    model.run_model(str(tmp_path / "run"))
+
+    resumed = World.load_checkpoint(os.path.join(tmp_path, "run", checkpoint), day=5)
+    resumed.run_model(str(tmp_path / "resumed"), offset=5)
+    assert outcome(resumed) == outcome(model)
+
+
+@pytest.mark.parametrize("mode, checkpoint", [("full", "GABM-5.pkl"), ("columnar", "GABM-5.npz")])
+def test_reasoning_log_is_found_from_another_directory(tmp_path, monkeypatch, mode, checkpoint):
+    from eval import build_panel
+    os.makedirs(tmp_path / "run" / "checkpoint")
+    os.makedirs(tmp_path / "elsewhere")
+    monkeypatch.chdir(tmp_path / "run")
+    model = make_world(mode)
+    model.mems_tail = 2 #streams the reasoning log in full mode too
+    model.run_model("checkpoint")
+
+    monkeypatch.chdir(tmp_path / "elsewhere")
+    path = str(tmp_path / "run" / "checkpoint" / checkpoint)
+    assert len(build_panel(World.load_checkpoint(path, load_mems=False))) == 5 * model.population
+    assert os.listdir(tmp_path / "elsewhere") == []
+
+    for chunk in os.listdir(tmp_path / "run" / "checkpoint" / "reasoning"):
+        os.remove(tmp_path / "run" / "checkpoint" / "reasoning" / chunk)
+    os.rmdir(tmp_path / "run" / "checkpoint" / "reasoning")
+    with pytest.raises(FileNotFoundError):
+        World.load_checkpoint(path)
+
+
+@pytest.mark.parametrize("mode, checkpoint", [("full", "GABM-10.pkl"), ("delta", "delta"), ("columnar", "GABM-10.npz")])
+def test_replay_reproduces_run(tmp_path, mode, checkpoint):
+    for directory in ["run", "replayed"]:
+        os.makedirs(tmp_path / directory)
+    model = make_world(mode)
+    model.step_count = 10
+    model.run_model(str(tmp_path / "run"))
+
+    args = get_parser().parse_args(["--backend", "replay", "--replay_from", os.path.join(tmp_path, "run", checkpoint),
+                                    "--cache_path", "", "--no_days", "10", "--infection_rate", "0.1"])
+    replayed = World(args, initial_healthy=190, initial_infected=10, contact_rate=5)
+    replayed.run_model(str(tmp_path / "replayed"))
+    assert replayed.seed == model.seed
+    assert outcome(replayed) == outcome(model)
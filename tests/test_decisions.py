@@ -0,0 +1,26 @@
+from main import get_parser
+from world import World
+
+
+def make_world(*flags):
+    args = get_parser().parse_args(["--backend", "synthetic", "--cache_path", "", "--seed", "0", "--fidelity", "--dedup_decisions", *flags])
+    return World(args, initial_healthy=95, initial_infected=5, contact_rate=5)
+
+
+def test_dedup_copies_are_tagged():
+    model = make_world()
+    decisions = model.get_decisions()
+    sources = [source for _, _, source in decisions]
+    groups = model.llm_usage.day["decision_groups"]
+    assert sources.count(model.backend.source) == groups
+    assert sources.count("dedup") == model.population - groups
+
+
+def test_dedup_replaces_whole_names_only():
+    model = make_world()
+    model.query_decisions = lambda agents, name=None: [(f"{agent.name} read the Article.", "No") for agent in agents]
+    for agent in model.schedule.agents:
+        agent.name = "Art" if agent.unique_id == 0 else "Bo"
+    decisions = model.get_decisions()
+    copied = [reasoning for reasoning, _, source in decisions if source == "dedup" and reasoning.startswith("Bo")]
+    assert copied and all(reasoning == "Bo read the Article." for reasoning in copied)
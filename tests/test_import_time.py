@@ -0,0 +1,16 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from import_time import BUDGETS, check
+
+#Multiplies every budget of benchmarks/import_time.py, e.g. IMPORT_BUDGET_SCALE=2 on slow CI machines
+SCALE = float(os.environ.get("IMPORT_BUDGET_SCALE", "1"))
+
+
+@pytest.mark.parametrize("module", list(BUDGETS))
+def test_import_time_budget(module):
+    [(_, seconds, budget, loaded)], _ = check([module], repeat=3, scale=SCALE)
+    assert not loaded, f"{module} imports {loaded} at startup"
+    assert seconds <= budget, f"{module} took {seconds:.3f} s to import, budget {budget:.2f} s"
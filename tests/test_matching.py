@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from main import get_parser
+from world import World
+from state import pair_contact_stubs
+
+POPULATION = 200
+SEEDS = range(5)
+
+
+def make_world(matching, contact_rate, seed):
+    args = get_parser().parse_args(["--backend", "synthetic", "--cache_path", "", "--matching", matching,
+                                    "--contact_rate", str(contact_rate), "--seed", str(seed)])
+    return World(args, initial_healthy=POPULATION - 2, initial_infected=2, contact_rate=contact_rate)
+
+
+def object_degrees(model, on_grid):
+    '''
+    Contacts of every agent on the grid after one World.decide_agent_interactions
+    '''
+    model.agents_on_grid = [model.schedule.agents[idx] for idx in on_grid]
+    model.decide_agent_interactions()
+    return np.array([len(agent.agent_interaction) for agent in model.agents_on_grid])
+
+
+def vectorized_degrees(contact_rate, on_grid, seed):
+    edges = pair_contact_stubs(np.asarray(on_grid), contact_rate, rng=np.random.default_rng(seed))
+    return np.bincount(edges.ravel(), minlength=POPULATION)[on_grid]
+
+
+def degree_histogram(degrees, contact_rate):
+    return np.bincount(degrees, minlength=contact_rate + 1) / len(degrees)
+
+
+@pytest.mark.parametrize("contact_rate", [2, 5, 10])
+def test_engines_match_legacy_degree_distribution(contact_rate):
+    on_grid = list(range(POPULATION))
+    degrees = {"legacy": np.concatenate([object_degrees(make_world("legacy", contact_rate, seed), on_grid) for seed in SEEDS]),
+               "stub": np.concatenate([object_degrees(make_world("stub", contact_rate, seed), on_grid) for seed in SEEDS]),
+               "vectorized": np.concatenate([vectorized_degrees(contact_rate, on_grid, seed) for seed in SEEDS])}
+
+    legacy = degree_histogram(degrees["legacy"], contact_rate)
+    for engine in ["stub", "vectorized"]:
+        assert degrees[engine].max() <= contact_rate
+        #Total variation distance between the degree histograms
+        assert 0.5 * np.abs(degree_histogram(degrees[engine], contact_rate) - legacy).sum() < 0.05
+        assert degrees[engine].mean() == pytest.approx(degrees["legacy"].mean(), rel=0.02)
+
+
+@pytest.mark.parametrize("matching", ["legacy", "stub"])
+def test_contacts_are_capped_by_agents_on_grid(matching):
+    #With 3 agents on the grid nobody can have more than 2 distinct contacts
+    model = make_world(matching, 5, 0)
+    degrees = object_degrees(model, [0, 1, 2])
+    assert model.max_potential_interactions == 2
+    assert degrees.max() <= 2
+    for agent in model.agents_on_grid:
+        assert len(set(map(id, agent.agent_interaction))) == len(agent.agent_interaction)
+        assert agent not in agent.agent_interaction
+    assert vectorized_degrees(2, [0, 1, 2], 0).max() <= 2
@@ -0,0 +1,41 @@
+import pytest
+from main import get_parser
+from world import World
+from state import AgentState, INFECTED, RECOVERED
+
+
+def make_world(engine, matching, seed=0):
+    args = get_parser().parse_args(["--backend", "synthetic", "--cache_path", "", "--engine", engine, "--matching", matching,
+                                    "--infection_rate", "0.3", "--fidelity", "--check_counters", "--seed", str(seed)])
+    return World(args, initial_healthy=95, initial_infected=5, contact_rate=5)
+
+
+@pytest.mark.parametrize("engine, matching", [("object", "legacy"), ("object", "stub"), ("vectorized", "stub")])
+def test_counters_stay_in_sync(engine, matching):
+    #--check_counters makes every step recompute the counters and raise on a mismatch
+    model = make_world(engine, matching)
+    for _ in range(12):
+        model.step()
+        assert model.state.compute_counters()["health_counts"] == model.state.health_counts.tolist()
+    assert model.state.count(RECOVERED) > 0 #the epidemic ran through the transitions being checked
+
+
+def test_citizen_setters_update_counters():
+    model = make_world("object", "stub")
+    agent = model.schedule.agents[0]
+    agent.health_condition = "Infected"
+    agent.day_infected = 4
+    agent.location = "home"
+    model.state.check_counters()
+    assert model.state.num_day_4 == 1
+    assert model.state.num_on_grid == model.population - 1
+
+
+def test_check_counters_detects_out_of_sync_arrays():
+    state = AgentState(10)
+    state.health[3] = INFECTED #bypasses set_health
+    with pytest.raises(RuntimeError):
+        state.check_counters()
+    state.recount()
+    state.check_counters()
+    assert state.count(INFECTED) == 1
@@ -1,24 +1,63 @@
-from names_dataset import NameDataset
 import numpy as np
 import random
-import openai
 import time
 import os
-import shutil
+import sqlite3
+import hashlib
+import json
+import threading
+import contextlib
 
 
-def probability_threshold(threshold):
+def probability_threshold(threshold, rng=np.random):
     '''
     Used in self.infect_interaction()
+    rng: NumPy generator of the World (see World.rng)
     '''
     #Generates random number from 0 to 1
     
-    return (np.random.rand()<threshold)
+    return (rng.random()<threshold)
 
-def generate_names(n: int, s: int, country_alpha2='US'):
+#Ranked names of each country, precomputed from NameDataset by build_name_table.
+#Bump NAME_TABLE_VERSION whenever the way the tables are built changes.
+NAME_TABLE_VERSION = 1
+NAME_TABLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "names")
+
+
+def name_table_path(country_alpha2, gender):
+    return os.path.join(NAME_TABLE_DIR, f"{country_alpha2}-v{NAME_TABLE_VERSION}-{gender.lower()}.npy")
+
+
+def build_name_table(country_alpha2='US'):
+    '''
+    Saves every male and female name NameDataset has for the country, most popular first.
+    NameDataset takes gigabytes of memory to load, so this only runs once per country and table version.
+    '''
+    from names_dataset import NameDataset
+    nd = NameDataset()
+    os.makedirs(NAME_TABLE_DIR, exist_ok=True)
+    for gender, key in [('Male', 'M'), ('Female', 'F')]:
+        names = nd.get_top_names(10**9, gender, country_alpha2)[country_alpha2][key]
+        np.save(name_table_path(country_alpha2, gender), np.array(names))
+
+
+def load_top_names(s: int, country_alpha2='US'):
+    '''
+    Returns the s//2 most popular male and the s//2 most popular female names in the country, most popular first,
+    read from the memory-mapped name tables (built on first use if missing)
+    Used in generate_names and get_name_ranks
+    '''
+    if not os.path.exists(name_table_path(country_alpha2, 'Male')):
+        build_name_table(country_alpha2)
+    male_names = np.load(name_table_path(country_alpha2, 'Male'), mmap_mode='r')[:s//2].tolist()
+    female_names = np.load(name_table_path(country_alpha2, 'Female'), mmap_mode='r')[:s//2].tolist()
+    return male_names, female_names
+
+
+def generate_names(n: int, s: int, country_alpha2='US', rng=random):
     '''
     Returns random names as names for agents from top names in the USA
-    Used in World.init to initialize agents
+    Used in World.init to initialize agents, with rng=World.random
     '''
 
     # This function will randomly selct n names (n/2 male and n/2 female) without
@@ -28,84 +67,97 @@ def generate_names(n: int, s: int, country_alpha2='US'):
     if s % 2 == 1:
         s += 1
 
-    nd = NameDataset()
-    male_names = nd.get_top_names(s//2, 'Male', country_alpha2)[country_alpha2]['M']
-    female_names = nd.get_top_names(s//2, 'Female', country_alpha2)[country_alpha2]['F']
+    male_names, female_names = load_top_names(s, country_alpha2)
     if s < n:
         raise ValueError(f"Cannot generate {n} unique names from a list of {s} names.")
     # generate names without repetition
-    names = random.sample(male_names, k=n//2) + random.sample(female_names, k=n//2)
+    names = rng.sample(male_names, k=n//2) + rng.sample(female_names, k=n//2)
     del male_names
     del female_names
-    random.shuffle(names)
+    rng.shuffle(names)
     return names
 
 
-def generate_big5_traits(n: int):
+def get_name_ranks(names, s: int, country_alpha2='US'):
     '''
-    Return big 5 traits for each agent
-    Used in World.init to initialize agents
+    Gender (1 male, 0 female, NaN if unknown) and popularity rank of each name among the s names
+    generate_names samples from, normalized as in eval.py: 1 for the most popular name, 1/(s/2) for the least.
+    Used in surrogate.py
     '''
+    if s % 2 == 1:
+        s += 1
+    male_names, female_names = load_top_names(s, country_alpha2)
+    male_name_rank = {name: rank+1 for rank, name in enumerate(male_names)}
+    female_name_rank = {name: rank+1 for rank, name in enumerate(female_names)}
 
-    #Trait generation
-    agreeableness_pos=['Cooperation','Amiability','Empathy','Leniency','Courtesy','Generosity','Flexibility',
-                        'Modesty','Morality','Warmth','Earthiness','Naturalness']
-    agreeableness_neg=['Belligerence','Overcriticalness','Bossiness','Rudeness','Cruelty','Pomposity','Irritability',
-                        'Conceit','Stubbornness','Distrust','Selfishness','Callousness']
-    #Did not use Surliness, Cunning, Predjudice,Unfriendliness,Volatility, Stinginess
+    gender = np.full(len(names), np.nan)
+    rank = np.full(len(names), np.nan)
+    for i, name in enumerate(names):
+        if name in male_name_rank:
+            gender[i], rank[i] = 1, male_name_rank[name]
+        elif name in female_name_rank:
+            gender[i], rank[i] = 0, female_name_rank[name]
+    return gender, 1 + 1/(s/2) - rank/(s/2)
 
-    conscientiousness_pos=['Organization','Efficiency','Dependability','Precision','Persistence','Caution','Punctuality',
-                            'Punctuality','Decisiveness','Dignity']
-    #Did not use Predictability, Thrift, Conventionality, Logic
-    conscientiousness_neg=['Disorganization','Negligence','Inconsistency','Forgetfulness','Recklessness','Aimlessness',
-                            'Sloth','Indecisiveness','Frivolity','Nonconformity']
 
-    surgency_pos=['Spirit','Gregariousness','Playfulness','Expressiveness','Spontaneity','Optimism','Candor'] 
+#Big 5 trait adjectives, positive and negative pole of each dimension
+TRAITS_POS = {
+    'agreeableness': ['Cooperation','Amiability','Empathy','Leniency','Courtesy','Generosity','Flexibility',
+                      'Modesty','Morality','Warmth','Earthiness','Naturalness'],
+    #Did not use Predictability, Thrift, Conventionality, Logic
+    'conscientiousness': ['Organization','Efficiency','Dependability','Precision','Persistence','Caution','Punctuality',
+                          'Punctuality','Decisiveness','Dignity'],
     #Did not use Humor, Self-esteem, Courage, Animation, Assertion, Talkativeness, Energy level, Unrestraint
-    surgency_neg=['Pessimism','Lethargy','Passivity','Unaggressiveness','Inhibition','Reserve','Aloofness'] 
+    'surgency': ['Spirit','Gregariousness','Playfulness','Expressiveness','Spontaneity','Optimism','Candor'],
+    'emotional_stability': ['Placidity','Independence'],
+    #Did not use Creativity, Curiousity, Sophistication
+    'intellect': ['Intellectuality','Depth','Insight','Intelligence'],
+}
+TRAITS_NEG = {
+    #Did not use Surliness, Cunning, Predjudice,Unfriendliness,Volatility, Stinginess
+    'agreeableness': ['Belligerence','Overcriticalness','Bossiness','Rudeness','Cruelty','Pomposity','Irritability',
+                      'Conceit','Stubbornness','Distrust','Selfishness','Callousness'],
+    'conscientiousness': ['Disorganization','Negligence','Inconsistency','Forgetfulness','Recklessness','Aimlessness',
+                          'Sloth','Indecisiveness','Frivolity','Nonconformity'],
     #Did not use Shyness, Silenece
-
-    emotional_stability_pos=['Placidity','Independence']
-    emotional_stability_neg=['Insecurity','Emotionality'] 
+    'surgency': ['Pessimism','Lethargy','Passivity','Unaggressiveness','Inhibition','Reserve','Aloofness'],
     #Did not use Fear, Instability, Envy, Gullibility, Intrusiveness
-    
-    intellect_pos=['Intellectuality','Depth','Insight','Intelligence'] 
-    #Did not use Creativity, Curiousity, Sophistication
-    intellect_neg=['Shallowness','Unimaginativeness','Imperceptiveness','Stupidity']
+    'emotional_stability': ['Insecurity','Emotionality'],
+    'intellect': ['Shallowness','Unimaginativeness','Imperceptiveness','Stupidity'],
+}
+TRAIT_DIMENSIONS = list(TRAITS_POS)
 
 
+def generate_big5_traits(n: int, rng=random):
+    '''
+    Return big 5 traits for each agent
+    Used in World.init to initialize agents, with rng=World.random
+    '''
+
     #Combine each trait
-    agreeableness_tot = agreeableness_pos + agreeableness_neg
-    conscientiousness_tot = conscientiousness_pos + conscientiousness_neg
-    surgency_tot = surgency_pos + surgency_neg
-    emotional_stability_tot = emotional_stability_pos + emotional_stability_neg
-    intellect_tot = intellect_pos + intellect_neg
+    traits_tot = [TRAITS_POS[dimension] + TRAITS_NEG[dimension] for dimension in TRAIT_DIMENSIONS]
 
     #create traits list to be returned
     traits_list = []
 
     for _ in range(n):
-        agreeableness_rand = random.choice(agreeableness_tot)
-        conscientiousness_rand = random.choice(conscientiousness_tot)
-        surgency_rand = random.choice(surgency_tot)
-        emotional_stability_rand = random.choice(emotional_stability_tot)
-        intellect_rand = random.choice(intellect_tot)
-
-        selected_traits=[agreeableness_rand,conscientiousness_rand,surgency_rand,
-                                emotional_stability_rand,intellect_rand]
-
-        traits_chosen = (', '.join(selected_traits))
-        traits_list.append(traits_chosen)
-    del agreeableness_rand
-    del conscientiousness_rand
-    del surgency_rand
-    del emotional_stability_rand
-    del intellect_rand
-    del selected_traits
-    del traits_chosen
+        selected_traits = [rng.choice(tot) for tot in traits_tot]
+        traits_list.append(', '.join(selected_traits))
     return traits_list
 
 
+def get_trait_scores(traits):
+    '''
+    (n, 5) array with 1 for each positive and 0 for each negative trait of the given "trait, trait, ..." strings
+    Used in eval.py and World.get_decisions
+    '''
+    scores = np.zeros((len(traits), len(TRAIT_DIMENSIONS)))
+    for i, selected_traits in enumerate(traits):
+        for j, (dimension, trait) in enumerate(zip(TRAIT_DIMENSIONS, selected_traits.split(', '))):
+            scores[i, j] = trait in TRAITS_POS[dimension]
+    return scores
+
+
 def update_day(agent):
     '''
     Update day funtion to update day_sick
@@ -146,25 +198,256 @@ def factorize(n):
             return (i, n // i)
     return (n, 1)
 
-def get_completion_from_messages(messages, model="gpt-3.5-turbo-0301", temperature=0):
-    success = False
-    retry = 0
-    max_retries = 30
-    while retry< max_retries and not success:
-      try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            temperature=temperature, # this is the degree of randomness of the model's output
-            )
-        success = True
-      except Exception as e:
-        print(f"Error: {e}\nRetrying...")
-        retry+=1
-        time.sleep(0.5)
-
-    return response.choices[0].message["content"]
-
-def clear_cache():
-    if os.path.exists("__pycache__"):
-        shutil.rmtree("__pycache__")
\ No newline at end of file
+#Semaphore shared by parallel runs to bound the number of LLM requests in flight, and RateLimiter shared by them
+#in place of each World's own, so the requests and tokens per minute hold across all runs (see main.run_replicates)
+_request_limiter = None
+_shared_rate_limiter = None
+
+
+def set_request_limiter(limiter, rate_limiter=None):
+    global _request_limiter, _shared_rate_limiter
+    _request_limiter = limiter
+    _shared_rate_limiter = rate_limiter
+
+
+def limit_requests():
+    '''
+    Holds a slot of the shared request limiter for the duration of one request, if a limiter is set
+    '''
+    return _request_limiter if _request_limiter is not None else contextlib.nullcontext()
+
+
+class ResponseCache:
+    '''
+    Disk-backed cache of chat completions stored in a SQLite file.
+    Keys are a hash of endpoint + model + messages + temperature, so answers of different backends
+    (e.g. the OpenAI API and a local server serving the same model name) are never mixed. Once more than max_entries
+    responses are stored, the least recently used ones are evicted.
+    Used in get_completion_from_messages
+    '''
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT, last_used INTEGER)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON responses (last_used)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(messages, model, temperature, endpoint):
+        '''
+        endpoint: what answered, e.g. "openai" or "http:" + the server's URL
+        '''
+        payload = json.dumps({"endpoint": endpoint, "model": model, "messages": messages, "temperature": temperature}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time_ns(), key))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, content):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO responses (key, content, last_used) VALUES (?, ?, ?)", (key, content, time.time_ns()))
+            excess = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+            if excess > 0: #Evict least recently used responses
+                conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)", (excess,))
+            conn.commit()
+
+    def __getstate__(self):
+        #SQLite connections and locks cannot be pickled with the World checkpoint
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class RateLimiter:
+    '''
+    Token buckets for requests per minute and tokens per minute, shared by all threads of a run,
+    or by all parallel runs through a main.LimiterManager proxy.
+    A limit of 0 disables that bucket. pause() holds back every request, e.g. for a Retry-After header.
+    Used in call_with_retries
+    '''
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_allowance = requests_per_minute
+        self.token_allowance = tokens_per_minute
+        self.last_refill = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.request_allowance = min(self.requests_per_minute, self.request_allowance + elapsed * self.requests_per_minute / 60)
+        self.token_allowance = min(self.tokens_per_minute, self.token_allowance + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens):
+        '''
+        Blocks until one request of about tokens tokens fits in both buckets, then takes it out of them
+        '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.paused_until - now
+                if wait <= 0:
+                    tokens_needed = min(tokens, self.tokens_per_minute)
+                    request_wait = (1 - self.request_allowance) * 60 / self.requests_per_minute if self.requests_per_minute else 0
+                    token_wait = (tokens_needed - self.token_allowance) * 60 / self.tokens_per_minute if self.tokens_per_minute else 0
+                    wait = max(request_wait, token_wait)
+                    if wait <= 0:
+                        self.request_allowance -= 1 if self.requests_per_minute else 0
+                        self.token_allowance -= tokens_needed
+                        return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self.last_refill = time.monotonic() #monotonic clocks differ between processes
+        self.paused_until = 0
+
+
+class LLMUsage:
+    '''
+    Per-call instrumentation of the LLM path, accumulated for the current day.
+    decision_groups counts the groups asked with World.dedup_decisions.
+    end_day() returns the day's totals and starts a new day.
+    Used in Citizen.get_response_and_reasoning, get_completion_from_messages and backends.HTTPBackend
+    '''
+    FIELDS = ["calls", "cache_hits", "prompt_tokens", "completion_tokens", "retries", "latency", "decision_groups"]
+
+    def __init__(self):
+        self.day = dict.fromkeys(self.FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for field, value in counts.items():
+                self.day[field] += value
+
+    def end_day(self):
+        with self._lock:
+            day, self.day = self.day, dict.fromkeys(self.FIELDS, 0)
+        return day
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+#Jitter has its own generator so that retries do not shift the simulation's random stream
+_jitter_random = random.Random()
+
+
+def get_retry_after(error):
+    '''
+    Seconds asked for by the Retry-After header of a failed request, if any
+    '''
+    headers = getattr(error, "headers", None)
+    try:
+        return float(headers.get("retry-after")) if headers else None
+    except (TypeError, ValueError):
+        return None
+
+
+def call_with_retries(request, tokens, rate_limiter=None, max_retries=8, base_delay=1, max_delay=60):
+    '''
+    Calls request() once the rate limiter allows a request of about tokens tokens.
+    Failed calls are retried up to max_retries times, after the Retry-After delay if the error carries one
+    and otherwise after an exponential backoff with full jitter. The last error is raised when retries run out.
+    Returns the result of request() and the number of retries it took.
+    Used in get_completion_from_messages and backends.HTTPBackend
+    '''
+    rate_limiter = _shared_rate_limiter if _shared_rate_limiter is not None else rate_limiter
+    for retry in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire(tokens)
+        try:
+            with limit_requests():
+                return request(), retry
+        except Exception as e:
+            if retry == max_retries:
+                raise
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                delay = retry_after
+                if rate_limiter is not None: #hold back the other threads as well
+                    rate_limiter.pause(retry_after)
+            else:
+                delay = _jitter_random.uniform(0, min(max_delay, base_delay * 2 ** retry))
+            print(f"Error: {e}\nRetrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+
+def estimate_tokens(messages, completion_tokens=100):
+    '''
+    Rough token count of a request (4 characters per token) for the tokens-per-minute bucket
+    '''
+    return sum(len(message["content"]) for message in messages) // 4 + completion_tokens
+
+
+def get_completion_from_messages(messages, model="gpt-3.5-turbo-0301", temperature=0, cache=None, rate_limiter=None, max_retries=8, usage=None):
+    import openai #imported on first use: it takes about half a second and only the openai backend needs it
+    if cache is not None:
+        key = cache.make_key(messages, model, temperature, "openai")
+        content = cache.get(key)
+        if content is not None:
+            if usage is not None:
+                usage.add(cache_hits=1)
+            return content
+
+    response, retries = call_with_retries(lambda: openai.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        temperature=temperature, # this is the degree of randomness of the model's output
+        ), estimate_tokens(messages), rate_limiter, max_retries)
+
+    content = response.choices[0].message["content"]
+    if usage is not None:
+        tokens = getattr(response, "usage", None) or {}
+        usage.add(prompt_tokens=tokens.get("prompt_tokens", 0), completion_tokens=tokens.get("completion_tokens", 0), retries=retries)
+    if cache is not None:
+        cache.put(key, content)
+    return content
@@ -1,10 +1,21 @@
 import mesa
-from citizen import Citizen
+from citizen import Citizen, CANONICAL_NAME
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from utils import generate_names,generate_big5_traits, factorize, update_day, clear_cache
-import random
+from backends import get_backend
+from checkpoint import DeltaCheckpointStore, CheckpointWriter, ReasoningLog, write_checkpoint, save_columnar, load_columnar
+from utils import generate_names,generate_big5_traits, factorize, update_day, get_trait_scores, ResponseCache, RateLimiter, LLMUsage
+import logging
+from prompts import PromptCompiler, batch_prompt, parse_batch_response
+from state import AgentState, SUSCEPTIBLE, INFECTED, RECOVERED, pair_contact_stubs
+import numpy as np
 import pickle
+import contextlib
+import time
+import os
+import re
+logger = logging.getLogger()
 
 
 # functions for mesa.DataCollector in World class
@@ -12,42 +23,50 @@ def compute_num_susceptible(model):
     '''
     Computers number of susceptible agents for data frame
     '''
-    return sum([1 for a in model.schedule.agents if a.health_condition == "Susceptible"])
+    return model.state.count(SUSCEPTIBLE)
 
 
 def compute_num_infected(model):
     '''
     Computers number of infected agents for data frame
     '''
-    return sum([1 for a in model.schedule.agents if a.health_condition == "Infected"])
+    return model.state.count(INFECTED)
 
 
 def compute_num_recovered(model):
     '''
     Computers number of recovered agents for data frame
     '''
-    return sum([1 for a in model.schedule.agents if a.health_condition == "Recovered"])
+    return model.state.count(RECOVERED)
 
 
 def compute_num_on_grid(model):
     '''
     Computers number of agents on the grid
     '''
-    return sum([1 for a in model.schedule.agents if a.location == "grid"])
+    return model.state.num_on_grid
 
 
 def compute_num_at_home(model):
     '''
     Computers number of agents at home
     '''
-    return sum([1 for a in model.schedule.agents if a.location == "home"])
+    return model.population - compute_num_on_grid(model)
 
 
 class World(mesa.Model):
     '''
     The world where Citizens exist
     '''
-    def __init__(self, args, initial_healthy=2, initial_infected=1, contact_rate=5):
+    #Attributes saved in every delta checkpoint (see checkpoint.DeltaCheckpointStore)
+    CHECKPOINT_SCALARS = ["current_date", "daily_new_cases", "infected", "max_potential_interactions", "total_contact_rates", "offset"]
+    CHECKPOINT_LISTS = ["track_contact_rate", "day_infected_is_4", "list_new_cases", "daily_llm_usage"]
+
+    def __init__(self, args, initial_healthy=2, initial_infected=1, contact_rate=5, personas=None):
+        '''
+        personas: optional (names, ages, traits) lists used instead of generating new ones,
+        e.g. when rebuilding a World from a columnar checkpoint
+        '''
         
         ########################################
         #     Intialization of the world       #
@@ -58,8 +77,11 @@ class World(mesa.Model):
         self.initial_infected=initial_infected
         self.population=initial_healthy+initial_infected
         self.step_count = args.no_days
+        self.checkpoint_mode = args.checkpoint_mode #"full" pickles the World every day, "delta" saves only the changes, "columnar" writes .npz files
+        self.checkpoint_queue = args.checkpoint_queue #Checkpoints waiting for the background writer before a day blocks, 0 writes them synchronously
         self.offset = 0 #Offset for checkpoint load
         self.name = args.name
+        self.args = dict(vars(args)) #Hyperparameters of the run, saved with columnar checkpoints
 
         #World creation initialization
         world_dimensions=factorize(self.population)
@@ -73,12 +95,47 @@ class World(mesa.Model):
         self.track_contact_rate = [0]
         self.day_infected_is_4 = [0]
         self.list_new_cases = [0] 
+        self.daily_llm_usage = [] #LLMUsage totals of each day
+        self.mems_tail = args.mems_tail #Days of mems kept in memory when streaming a reasoning log, 0 keeps all
+        self.reasoning_log = None #ReasoningLog every decision is streamed to, opened by run_model if mems_tail is set or checkpoints are columnar
         self.daily_new_cases = initial_infected
         self.infected = initial_infected
         self.contact_rate= args.contact_rate
         self.infection_rate = args.infection_rate
         self.agents_on_grid=[]
         self.max_potential_interactions=0
+        self.matching = args.matching #Contact matching engine: "legacy" or "stub"
+        self.engine = args.engine #"object" steps each Citizen, "vectorized" steps the whole AgentState at once
+        self.state = AgentState(self.population) #Health and location arrays viewed by the Citizens
+        self.check_counters = args.check_counters #Recompute the state counters every day to check them
+        self.max_concurrency = args.max_concurrency #Number of LLM requests in flight during the decision phase
+        self.dedup_decisions = args.dedup_decisions #Query once per group of agents with identical prompts
+        self.canonical_names = args.canonical_names #Replace names with CANONICAL_NAME in deduplicated prompts
+        self.dedup_age_band = args.dedup_age_band #Years of age per deduplication group
+        self.batch_size = args.batch_size #Agents asked per LLM request, 1 asks every agent on its own
+        self.fidelity = args.fidelity #Ask every agent every day, even when no decision can change an infection (see plan_decisions)
+
+        #Persistent LLM response cache, shared between runs that point to the same file
+        self.response_cache = ResponseCache(args.cache_path, args.cache_size) if args.cache_path else None
+        #Requests and tokens per minute shared by all decision threads, and requeues of failed decisions
+        self.rate_limiter = RateLimiter(args.requests_per_minute, args.tokens_per_minute)
+        self.max_requeues = args.max_requeues
+        self.prompts = PromptCompiler(args.prompt_layout) #Per-agent prompt templates, "legacy" or "prefix" layout
+        self.llm_usage = LLMUsage() #Calls, tokens, retries, cache hits and latency of the current day's decisions
+        #Answers the stay-at-home prompts (OpenAI, local HTTP server, replay of a past run or synthetic rules)
+        self.backend = get_backend(args, self.response_cache, self.rate_limiter, self.llm_usage)
+
+        #Every random draw of the run comes from these two generators, so a run is reproduced by its seed.
+        #Unseeded runs draw a fresh seed, replays reuse the seed of the replayed run.
+        if args.seed is not None:
+            self.seed = args.seed
+        elif args.backend == "replay":
+            self.seed = self.backend.recorded_seed()
+        else:
+            self.seed = np.random.SeedSequence().entropy
+        self.args["seed"] = self.seed
+        self.reset_randomizer(self.seed) #mesa's self.random, also used by the scheduler
+        self.rng = np.random.default_rng(self.seed)
         #Initialize Schedule
         self.schedule = mesa.time.RandomActivation(self)
 
@@ -91,7 +148,7 @@ class World(mesa.Model):
                             "Recovered": compute_num_recovered,
                             "# Home": compute_num_at_home,
                             "# Grid":compute_num_on_grid
-                            })
+                            }) #LLM usage is collected after each step in daily_llm_usage (see eval.run_stats)
         
 
         ########################################
@@ -101,9 +158,13 @@ class World(mesa.Model):
         #IDs for agents
         agent_id = 0 
 
-        #generates list of random names out of the 200 most common names in the US
-        names = generate_names(self.population, self.population*2)
-        traits = generate_big5_traits(self.population)
+        if personas is None:
+            #generates list of random names out of the 200 most common names in the US
+            names = generate_names(self.population, self.population*2, rng=self.random)
+            traits = generate_big5_traits(self.population, rng=self.random)
+            ages = [self.random.randrange(18,65) for _ in range(self.population)]
+        else:
+            names, ages, traits = personas
 
         #for loop to initialize each agents
         for i in range(self.population):
@@ -124,7 +185,7 @@ class World(mesa.Model):
             #create instances of the Citizen class
     
             citizen = Citizen(model=self,
-                            unique_id=agent_id,name=names[i],age=random.randrange(18,65),
+                            unique_id=agent_id,name=names[i],age=ages[i],
                             traits=traits[i],
                             location=location ,pos=None,
                             health_condition=health_condition, day_infected=day_infected,
@@ -136,6 +197,16 @@ class World(mesa.Model):
             agent_id += 1 
 
         self.distribute_agents() #distributes agents in the grid world
+        if not self.backend.vectorized: #vectorized backends answer from the state arrays without prompts
+            self.prompts.compile_all(self.schedule.agents)
+
+    @property
+    def cache_hits(self):
+        return self.response_cache.hits if self.response_cache is not None else 0
+
+    @property
+    def cache_misses(self):
+        return self.response_cache.misses if self.response_cache is not None else 0
 
     def distribute_agents(self):
         grid_size = (self.width,self.height)
@@ -151,27 +222,216 @@ class World(mesa.Model):
         Decides interaction partners for each agent
         '''
         self.max_potential_interactions = min(self.contact_rate, len(self.agents_on_grid) - 1)
-        random.shuffle(self.agents_on_grid)
+        self.random.shuffle(self.agents_on_grid)
+        if self.matching == "stub":
+            self.pair_contact_stubs()
+            return
+
         for agent in self.agents_on_grid:
             potential_interactions = [a for a in self.agents_on_grid if a is not agent and a not in agent.agent_interaction]
         
         #Not all agents will have 5 contacts as it is slightly random the order.
             while len(agent.agent_interaction) < self.max_potential_interactions and potential_interactions:
-                other_agent = random.choice(potential_interactions)
+                other_agent = self.random.choice(potential_interactions)
                 agent.add_agent_interaction(other_agent)
                 potential_interactions.remove(other_agent)
 
+    def pair_contact_stubs(self, max_rounds=10):
+        '''
+        Stub-pairing (configuration model) version of decide_agent_interactions, linear in the number of contacts.
+        Every agent on the grid gets max_potential_interactions stubs, which are shuffled and paired up.
+        Self-pairs and repeated pairs are dropped and their stubs are reshuffled for up to max_rounds rounds,
+        so no agent ends up with more contacts than the contact rate.
+        '''
+        agents = self.agents_on_grid
+        stubs = [idx for idx in range(len(agents)) for _ in range(self.max_potential_interactions)]
+        partners = [set() for _ in agents]
+
+        for _ in range(max_rounds):
+            self.random.shuffle(stubs)
+            leftover_stubs = stubs[len(stubs) - len(stubs) % 2:]
+            for k in range(0, len(stubs) - 1, 2):
+                a, b = stubs[k], stubs[k + 1]
+                if a == b or b in partners[a]:
+                    leftover_stubs += [a, b]
+                    continue
+                partners[a].add(b)
+                partners[b].add(a)
+                agents[a].agent_interaction.append(agents[b])
+                agents[b].agent_interaction.append(agents[a])
+                self.total_contact_rates += 2
+            stubs = leftover_stubs
+            if len(stubs) < 2:
+                break
+
+    def query_decisions(self, agents, name=None, batch_size=None):
+        '''
+        Queries (reasoning, response) of the given agents, with up to max_concurrency requests at once.
+        Agents whose request still fails after the backend's retries are requeued behind the rest of the day's
+        decisions, up to max_requeues times, so one throttled agent does not stall the others.
+        With batch_size (self.batch_size by default) above 1 and a backend that supports batching, each request
+        asks for batch_size agents (see ask_batch); agents missing or malformed in a batched answer are asked again on their own.
+        '''
+        batch_size = self.batch_size if batch_size is None else batch_size
+        if batch_size > 1 and self.backend.supports_batching:
+            ask = lambda batch: self.ask_batch(batch, name)
+        else:
+            batch_size = 1
+            ask = lambda batch: [batch[0].get_response_and_reasoning(name)]
+        decisions = [None] * len(agents)
+        pending = [range(start, min(start + batch_size, len(agents))) for start in range(0, len(agents), batch_size)]
+        for attempt in range(self.max_requeues + 1):
+            failed = []
+            with ThreadPoolExecutor(max_workers=max(self.max_concurrency, 1)) as executor:
+                futures = [(batch, executor.submit(ask, [agents[idx] for idx in batch])) for batch in pending]
+                for batch, future in futures:
+                    try:
+                        for idx, decision in zip(batch, future.result()):
+                            decisions[idx] = decision
+                    except Exception as e:
+                        logger.warning(f"Decision of agents {[agents[idx].unique_id for idx in batch]} failed: {e}")
+                        failed.append(batch)
+            if not failed:
+                break
+            pending = failed
+            if attempt < self.max_requeues:
+                logger.warning(f"Requeueing {len(failed)} failed requests (requeue {attempt+1} of {self.max_requeues})")
+        else:
+            raise RuntimeError(f"Decisions of {sum(map(len, pending))} agents still failed after {self.max_requeues} requeues.")
+
+        malformed = [idx for idx, decision in enumerate(decisions) if decision is None]
+        if malformed:
+            logger.warning(f"{len(malformed)} agents were missing or malformed in batched answers, asking them one by one")
+            for idx, decision in zip(malformed, self.query_decisions([agents[idx] for idx in malformed], name, batch_size=1)):
+                decisions[idx] = decision
+        return decisions
+
+    def ask_batch(self, agents, name=None):
+        '''
+        (reasoning, response) of each agent from a single prompts.batch_prompt request,
+        None for agents missing or malformed in the answer.
+        name: name used in the prompt instead of the agents' own names (see get_decisions)
+        '''
+        new_cases = (self.day_infected_is_4[self.schedule.steps]*100)/self.population
+        residents = [(agent.name if name is None else name, agent.age, agent.traits, agent.get_health_string(name)) for agent in agents]
+        messages = [{'role':'system', 'content':batch_prompt(residents, new_cases)}]
+        start = time.perf_counter()
+        output = self.backend.complete(messages, agents[0])
+        self.llm_usage.add(calls=1, latency=time.perf_counter() - start)
+        return parse_batch_response(output, len(agents))
+
+    def get_decision_key(self, agent, polarity):
+        '''
+        Decision-relevant fields of an agent's prompt, coarsened so that similar agents share a group:
+        the polarity of its traits (see utils.get_trait_scores), its age band, its health line and the newspaper's count
+        '''
+        return (polarity, agent.age // max(self.dedup_age_band, 1), agent.get_health_string(CANONICAL_NAME), self.day_infected_is_4[self.schedule.steps])
+
+    def decisions_are_inert(self):
+        '''
+        True when no stay-at-home decision can change an infection, today or on any later day:
+        nobody is infected (nobody can be infected again) or nobody is susceptible (nobody can be infected at all)
+        '''
+        return self.state.count(INFECTED) == 0 or self.state.count(SUSCEPTIBLE) == 0
+
+    def plan_decisions(self):
+        '''
+        Decisions of a day on which decisions_are_inert, made without asking the backend.
+        Policy: every agent keeps the location it chose the day before, so contacts are still matched
+        and counted as usual and the contact-rate statistics keep following the agents' last decisions.
+        They are recorded in mems with source "planner".
+        '''
+        reasoning = "Kept the previous day's location: no decision could change an infection."
+        return [(reasoning, "Yes" if agent.location == "home" else "No", "planner") for agent in self.schedule.agents]
+
+    def get_decisions(self):
+        '''
+        Queries the stay-at-home decision of every agent.
+        Returns (reasoning, response, source) tuples in schedule order so they can be applied serially.
+        Unless fidelity is set, days on which decisions_are_inert are planned instead (see plan_decisions).
+        With dedup_decisions, agents sharing a decision key are asked once through their first member
+        and the answer is fanned out, with the asked name in the reasoning replaced by each member's name.
+        The copies are recorded with source "dedup", so they are not mistaken for decisions the members were asked.
+        The number of groups asked is recorded as the day's decision_groups in llm_usage.
+        '''
+        agents = self.schedule.agents
+        if not self.fidelity and self.decisions_are_inert():
+            return self.plan_decisions()
+        if self.backend.vectorized:
+            return self.backend.decide_day(self)
+        source = self.backend.source
+        if not self.dedup_decisions:
+            return [(reasoning, response, source) for reasoning, response in self.query_decisions(agents)]
+
+        groups = {}
+        for agent, scores in zip(agents, get_trait_scores([agent.traits for agent in agents])):
+            groups.setdefault(self.get_decision_key(agent, tuple(scores.astype(bool))), []).append(agent)
+        representatives = [members[0] for members in groups.values()]
+        self.llm_usage.add(decision_groups=len(groups))
+        logger.info(f"Asking {len(groups)} decision groups for {len(agents)} agents")
+        if self.canonical_names:
+            answers = self.query_decisions(representatives, CANONICAL_NAME)
+        else:
+            answers = self.query_decisions(representatives)
+
+        decisions = {}
+        for members, (reasoning, response) in zip(groups.values(), answers):
+            asked_name = re.compile(rf"\b{re.escape(CANONICAL_NAME if self.canonical_names else members[0].name)}\b")
+            for agent in members:
+                member_reasoning = asked_name.sub(lambda _: agent.name, reasoning) if reasoning is not None else None
+                decisions[agent.unique_id] = (member_reasoning, response, source if agent is members[0] else "dedup")
+        return [decisions[agent.unique_id] for agent in agents]
+
+    def vectorized_step(self, decisions):
+        '''
+        Array-backed version of the rest of self.step, used when engine is "vectorized".
+        Decisions are recorded through the Citizens; contact matching, infection, update_day
+        and case tracking run as batched NumPy operations on self.state.
+        '''
+        agents = self.schedule.agents
+        stay_home = np.array([agent.ask_agent_stay_at_home(decision) for agent, decision in zip(agents, decisions)], dtype=bool)
+        self.state.set_locations(np.array([agent.unique_id for agent in agents]), ~stay_home)
+
+        on_grid_idx = np.flatnonzero(self.state.on_grid)
+        self.max_potential_interactions = min(self.contact_rate, len(on_grid_idx) - 1)
+        edges = pair_contact_stubs(on_grid_idx, self.max_potential_interactions, rng=self.rng)
+        self.track_contact_rate.append(2 * len(edges)) #every contact counts for both agents
+
+        self.state.infect(edges, self.infection_rate, rng=self.rng)
+        self.schedule.steps += 1
+        self.schedule.time += 1
+
+        new_cases, healed = self.state.update_day()
+        self.daily_new_cases += new_cases
+        self.infected += new_cases - healed
+        self.day_infected_is_4.append(self.state.num_day_4)
+        if self.check_counters:
+            self.state.check_counters()
+
+    def trim_mems(self):
+        '''
+        Drops the mems entries older than the last mems_tail steps, which are kept in the reasoning log
+        '''
+        if not self.mems_tail:
+            return
+        oldest = self.schedule.steps - self.mems_tail
+        for agent in self.schedule.agents:
+            for step in [step for step in agent.mems if isinstance(step, int) and step < oldest]:
+                del agent.mems[step]
+
     def step(self):
         '''
         Model time step
         '''
-        
-        for agent in self.schedule.agents: #Cycle through each agent's substep
-            agent.prepare_step()
-        self.decide_agent_interactions()
-       
-        for agent in self.schedule.agents: #track global contact rate
-            self.total_contact_rates += len(agent.agent_interaction)
+        decisions = self.get_decisions()
+        self.daily_llm_usage.append(self.llm_usage.end_day())
+        if self.engine == "vectorized":
+            self.vectorized_step(decisions)
+            return
+
+        for agent, decision in zip(self.schedule.agents, decisions): #Apply decisions in agent order
+            agent.prepare_step(decision)
+        self.decide_agent_interactions() #also counts the contacts in self.total_contact_rates
         self.track_contact_rate.append(self.total_contact_rates)
         self.total_contact_rates = 0
 
@@ -183,18 +443,46 @@ class World(mesa.Model):
             update_day(agent)
         
         #track how many agents have been infected for 4 days for case feedback
-        self.day_infected_is_4.append(sum([True if agent.day_infected==4 else False for agent in self.schedule.agents]))          
+        self.day_infected_is_4.append(self.state.num_day_4)
+        if self.check_counters:
+            self.state.check_counters()
 
     #Function to actually run the model
     def run_model(self, checkpoint_path, offset=0):
+        '''
+        Runs the remaining days. Daily checkpoints and reasoning-log chunks are serialized at the end of each day
+        and written by a background CheckpointWriter (unless checkpoint_queue is 0), which every pending write
+        is flushed from before run_model returns or raises.
+        '''
+        writer = CheckpointWriter(self.checkpoint_queue) if self.checkpoint_queue > 0 else None
+        with writer if writer is not None else contextlib.nullcontext():
+            self.run_days(checkpoint_path, offset, writer)
+
+    def run_days(self, checkpoint_path, offset, writer):
+        '''
+        Days offset to step_count of run_model, with checkpoints written through writer (None writes them synchronously)
+        '''
         self.offset = offset
         end_program=0
+        if self.checkpoint_mode == "delta":
+            store = DeltaCheckpointStore(checkpoint_path + "/delta", writer)
+            if offset == 0:
+                store.clear() #Fresh run: drop the checkpoints of any earlier attempt
+            else:
+                store.track(self, offset)
+        if self.mems_tail or self.checkpoint_mode == "columnar": #columnar checkpoints refer to the log for their decisions
+            os.makedirs(checkpoint_path + "/reasoning", exist_ok=True)
+            self.reasoning_log = ReasoningLog(checkpoint_path + "/reasoning")
+            self.reasoning_log.clear(self.schedule.steps) #Drop chunks written after the checkpoint the run resumes from
         for i in tqdm(range(self.offset,self.step_count)):
             #collect model level data
             self.datacollector.collect(self)
 
             #Model steps
             self.step()
+            if self.reasoning_log is not None:
+                self.reasoning_log.write(self, self.schedule.steps - 1, writer)
+                self.trim_mems()
 
             #collect all new cases from one day
             self.list_new_cases.append(self.daily_new_cases)
@@ -206,6 +494,8 @@ class World(mesa.Model):
             print(f"Total Pop: {self.population}\tNew Cases: {self.list_new_cases}")
             print (f"Currently Infected: {self.infected}")
             print(f"Agent Perspective New cases: {self.day_infected_is_4}")
+            if self.response_cache is not None:
+                print(f"Response cache hits: {self.cache_hits}\tmisses: {self.cache_misses}")
 
             """
             early stopping condition: if there are no more infected agents left, 
@@ -215,21 +505,71 @@ class World(mesa.Model):
                 end_program+=1
             if end_program == 2:
                 path = checkpoint_path + f"/{self.name}-final_early.pkl"
-                self.save_checkpoint(file_path = path)
+                self.save_checkpoint(file_path = path, writer = writer)
                 break
 
             self.current_date += timedelta(days=1)
-            path = checkpoint_path+f"/{self.name}-{i+1}.pkl"
-            self.save_checkpoint(file_path = path)
-            clear_cache()
+            if self.checkpoint_mode == "delta":
+                store.save(self, i+1)
+            else:
+                extension = "npz" if self.checkpoint_mode == "columnar" else "pkl"
+                path = checkpoint_path+f"/{self.name}-{i+1}.{extension}"
+                self.save_checkpoint(file_path = path, writer = writer)
+
 
+    def get_rng_state(self):
+        '''
+        JSON-serializable state of self.random and self.rng, saved with delta and columnar checkpoints
+        '''
+        version, internal, gauss = self.random.getstate()
+        return {"random": [version, list(internal), gauss], "numpy": self.rng.bit_generator.state}
 
-    #saves checkpoint to specified file path
-    def save_checkpoint(self, file_path):
-        with open(file_path,"wb") as file:
-            pickle.dump(self, file)
+    def set_rng_state(self, state):
+        version, internal, gauss = state["random"]
+        self.random.setstate((version, tuple(internal), gauss))
+        self.rng.bit_generator.state = state["numpy"]
+
+    def get_schedule_order(self):
+        '''
+        Agent IDs in the scheduler's activation order, which RandomActivation reshuffles in place every day.
+        Saved with delta and columnar checkpoints, so a resumed run draws in the same order as the original.
+        '''
+        return np.array([agent.unique_id for agent in self.schedule.agents], dtype=np.int64)
+
+    def set_schedule_order(self, order):
+        agents = {agent.unique_id: agent for agent in self.schedule.agents}
+        for agent in agents.values():
+            self.schedule.remove(agent)
+        for uid in order:
+            self.schedule.add(agents[int(uid)])
+
+    #saves checkpoint to specified file path, as a columnar checkpoint if it ends with .npz
+    def save_checkpoint(self, file_path, writer=None):
+        '''
+        Pickles the World to file_path, or writes a columnar checkpoint if it ends with .npz.
+        writer: CheckpointWriter the serialized checkpoint is handed to instead of being written right away
+        '''
+        if file_path.endswith(".npz"):
+            save_columnar(self, file_path, writer)
+            return
+        write_checkpoint(file_path, pickle.dumps(self), writer)
     
     @staticmethod
-    def load_checkpoint(file_path):
-        with open(file_path,"rb") as file:
-            return pickle.load(file)
+    def load_checkpoint(file_path, day=None, load_mems=True):
+        '''
+        Loads a pickled World, a columnar .npz checkpoint (without reading its reasoning log into mems if load_mems is False),
+        or the World at the end of day from a delta checkpoint directory.
+        The reasoning log of the loaded World ends at its step, so later days of the run are not read through it,
+        and must exist: a missing log raises FileNotFoundError.
+        '''
+        if os.path.isdir(file_path):
+            model = DeltaCheckpointStore(file_path).load(day)
+        elif file_path.endswith(".npz"):
+            return load_columnar(file_path, World, load_mems)
+        else:
+            with open(file_path,"rb") as file:
+                model = pickle.load(file)
+        if model.reasoning_log is not None:
+            model.reasoning_log.end = model.schedule.steps
+            model.reasoning_log.check()
+        return model